@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+"""asyncio client engine: async GET, POST, download and upload over keep-alive connections"""
+
+import asyncio, os, re, sys, json, time, mimetypes, argparse
+from urllib.parse import urljoin, urlencode
+import httpclient
+
+READ_SIZE = 64 * 1024
+
+class AsyncConnection:
+    """A persistent stream connection to one (scheme, host, port)"""
+    
+    def __init__(self, key, reader, writer):
+        self.key, self.reader, self.writer = key, reader, writer
+        self.last_used = time.monotonic()
+        self.requests = 0
+    
+    def close(self):
+        self.writer.close()
+
+class AsyncResponse:
+    """Response whose body is streamed on demand; holds its per-host slot until released"""
+    _content = _text = None
+    
+    def __init__(self, client, conn, method, keep_alive, trace=None):
+        self.client, self.conn, self.method, self.keep_alive = client, conn, method, keep_alive
+        self.trace = trace
+        self.finished = False
+        self.url, self.history = None, []  # Set by fetch(): the final URL and the redirects that led to it
+    
+    async def _read_head(self):
+        # The first byte on its own tells a connection closed before any response from one closed inside it
+        try:
+            head = await self.conn.reader.readexactly(1)
+        except (asyncio.IncompleteReadError, ConnectionResetError) as e:
+            raise httpclient.NoResponse("Connection closed before response headers") from e
+        if self.trace:
+            self.trace.mark('wait')
+        head += await self.conn.reader.readuntil(b'\r\n\r\n')
+        self.status, self.reason, self.headers = httpclient.parse_head(head[:-4])
+        # Interim responses (100 Continue, 103 Early Hints) precede the final one; 101 is left to the caller
+        while 100 <= self.status < 200 and self.status != 101:
+            head = await self.conn.reader.readuntil(b'\r\n\r\n')
+            self.status, self.reason, self.headers = httpclient.parse_head(head[:-4])
+        self.head = head[:-4]
+        if self.trace:
+            self.trace.status, self.trace.bytes_received = self.status, len(head)
+        self.framing, self.keep_alive = httpclient.body_framing(
+            self.method, self.status, self.head, self.headers, self.keep_alive)
+    
+    async def _recv(self, n=READ_SIZE):
+        return await asyncio.wait_for(self.conn.reader.read(n), self.client.timeout)
+    
+    async def iter_body(self):
+        """Yield decoded body pieces; the connection goes back to the client at the end"""
+        if self._content is not None:
+            yield self._content
+            return
+        decoder = httpclient.ContentDecoder.for_headers(self.headers)
+        async for piece in self._iter_framed():
+            if self.trace:
+                self.trace.bytes_received += len(piece)
+            if decoder:
+                for out in decoder.feed(piece):
+                    yield out
+            else:
+                yield piece
+        if decoder and (tail := decoder.flush()):
+            yield tail
+        self.finished = True
+        if self.trace:
+            self.trace.mark('transfer')
+        self.release()
+    
+    async def _iter_framed(self):
+        if 'chunked' in self.framing.get('transfer-encoding', '').lower():
+            decoder = httpclient.ChunkedDecoder()
+            while not decoder.done:
+                data = await self._recv()
+                if not data:
+                    raise ConnectionError("Connection closed inside chunked body")
+                for piece in decoder.feed(data):
+                    yield piece
+        elif 'content-length' in self.framing:
+            remaining = int(self.framing['content-length'])
+            while remaining:
+                data = await self._recv(min(READ_SIZE, remaining))
+                if not data:
+                    raise ConnectionError(f"Connection closed with {remaining} bytes missing")
+                remaining -= len(data)
+                yield data
+        else:
+            while data := await self._recv():
+                yield data
+    
+    async def read(self):
+        """Read the whole body; it is kept, so later calls (and text(), json()) do not read again"""
+        if self._content is None:
+            self._content = b''.join([piece async for piece in self.iter_body()])
+        return self._content
+    
+    @property
+    def charset(self):
+        return httpclient.content_charset(self.headers)
+    
+    async def text(self):
+        """The body decoded with the declared charset (UTF-8 if none)"""
+        if self._text is None:
+            self._text = (await self.read()).decode(self.charset, errors='replace')
+        return self._text
+    
+    async def json(self):
+        return json.loads(await self.read() if self.charset.startswith('utf') else await self.text())
+    
+    async def iter_json(self):
+        """Decode the body as it streams: each element of a top-level array, or the whole document"""
+        decoder = httpclient.JsonStreamDecoder(self.charset)
+        async for piece in self.iter_body():
+            for value in decoder.feed(piece):
+                yield value
+        for value in decoder.flush():
+            yield value
+    
+    def release(self):
+        """Give the connection back, dropping it if the body was not fully read"""
+        if self.conn:
+            self.client._release(self.conn, self.finished and self.keep_alive)
+            self.conn = None
+            if self.trace:
+                self.trace.emit()
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc):
+        self.release()
+
+class AsyncClient:
+    """Async counterpart of httpclient's pool, with per-host concurrency limits and timeouts"""
+    
+    def __init__(self, per_host=8, timeout=30, idle_timeout=30):
+        self.per_host, self.timeout, self.idle_timeout = per_host, timeout, idle_timeout
+        self.idle = {}    # key -> idle connections, most recently used last
+        self.limits = {}  # key -> semaphore bounding concurrent requests to that host
+    
+    def _limit(self, key):
+        if key not in self.limits:
+            self.limits[key] = asyncio.Semaphore(self.per_host)
+        return self.limits[key]
+    
+    async def _connect(self, key, trace=None):
+        idle = self.idle.get(key, [])
+        while idle:
+            conn = idle.pop()
+            if time.monotonic() - conn.last_used < self.idle_timeout and not conn.reader.at_eof():
+                return conn
+            conn.close()
+        
+        scheme, host, port = key
+        # Share the blocking client's SSL context and DNS cache (asyncio has no SSLSession parameter)
+        addresses = await asyncio.get_running_loop().run_in_executor(None, httpclient.resolve, host, port, trace)
+        tls = dict(ssl=httpclient.ssl_context(), server_hostname=host) if scheme == 'https' else {}
+        for n, (family, _, _, _, address) in enumerate(addresses, 1):
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(address[0], address[1], family=family, **tls), self.timeout)
+                if trace:
+                    trace.mark('connect')  # Includes the TLS handshake for https
+                return AsyncConnection(key, reader, writer)
+            except OSError:
+                if n == len(addresses):
+                    httpclient.dns_cache.pop((host, port), None)
+                    raise
+    
+    def _release(self, conn, reuse):
+        if reuse:
+            conn.last_used = time.monotonic()
+            conn.requests += 1
+            self.idle.setdefault(conn.key, []).append(conn)
+        else:
+            conn.close()
+        self._limit(conn.key).release()
+    
+    async def request(self, method, url, headers=None, body=None):
+        """Send a request and return the AsyncResponse once its headers have arrived"""
+        # body may also be an async iterable of bytes, which is sent chunked
+        chunked_body = body is not None and hasattr(body, '__aiter__')
+        if chunked_body:
+            headers = dict(headers or {}, **{"Transfer-Encoding": "chunked"})
+        scheme, host, port, head, parts, keep_alive, chunked = httpclient.prepare_request(
+            method, url, headers, None if chunked_body else body)
+        if chunked_body:
+            parts = [body]
+        key = (scheme, host, port)
+        files = [(part, part.tell()) for part in parts if httpclient.is_regular_file(part)]
+        retry = httpclient.replayable(parts)
+        trace = httpclient.new_trace(method, url)
+        await self._limit(key).acquire()
+        
+        while True:
+            try:
+                conn = await self._connect(key, trace)
+            except BaseException as e:
+                self._limit(key).release()
+                if trace:
+                    trace.emit(e)
+                raise
+            sent = None
+            try:
+                sent = await asyncio.wait_for(self._send(conn, head, parts, chunked), self.timeout)
+                if trace:
+                    trace.sent(conn, sent)
+                resp = AsyncResponse(self, conn, method, keep_alive, trace)
+                await asyncio.wait_for(resp._read_head(), self.timeout)
+                return resp
+            except (OSError, asyncio.IncompleteReadError) as e:
+                conn.close()
+                # The server may close an idle connection just as we reuse it: try another one
+                if not conn.requests or not retry or not httpclient.stale_connection(e, sent):
+                    self._limit(key).release()
+                    if trace:
+                        trace.emit(e)
+                    raise ConnectionError(str(e)) from e
+                for f, pos in files:
+                    f.seek(pos)
+            except BaseException as e:
+                conn.close()
+                self._limit(key).release()
+                if trace:
+                    trace.emit(e)
+                raise
+    
+    async def fetch(self, method, url, headers=None, body=None, max_redirects=httpclient.MAX_REDIRECTS,
+                    cookies=None, memo=None):
+        """request() that follows redirects like httpclient.fetch(), return the final AsyncResponse"""
+        chain = httpclient.RedirectChain(method, url, headers, body, max_redirects, cookies, memo)
+        while True:
+            resp = await self.request(*chain.next_request())
+            try:
+                if chain.done(resp):
+                    return resp
+                await resp.read()  # Drained, so a same-origin next hop reuses the connection
+            except BaseException:
+                resp.release()
+                raise
+    
+    async def _send(self, conn, head, parts, chunked=False):
+        """Write the request, waiting for the socket to drain after every block; return the bytes sent"""
+        sent = len(head)
+        conn.writer.write(head)
+        for part in parts:
+            async for block in self._blocks(part):
+                if chunked:
+                    block = b'%x\r\n' % len(block) + block + b'\r\n'
+                conn.writer.write(block)
+                sent += len(block)
+                await conn.writer.drain()
+        if chunked:
+            conn.writer.write(b'0\r\n\r\n')
+            sent += 5
+        await conn.writer.drain()
+        return sent
+    
+    @staticmethod
+    async def _blocks(part):
+        # Files and streams in fixed blocks, async iterables as they produce data
+        if hasattr(part, '__aiter__'):
+            async for block in part:
+                if block:
+                    yield block.encode() if isinstance(block, str) else bytes(block)
+        elif hasattr(part, 'read'):
+            while block := httpclient.read_block(part, READ_SIZE):
+                yield block
+        else:
+            for block in httpclient.iter_part(part):
+                if block:
+                    yield bytes(block)
+    
+    def close(self):
+        """Close every idle connection"""
+        for idle in self.idle.values():
+            for conn in idle:
+                conn.close()
+        self.idle.clear()
+
+async def http_get(client, url):
+    """Fetch a page and return its title (async counterpart of httpget.http_get)"""
+    async with await client.fetch("GET", url) as resp:
+        body = await resp.text()
+    title = re.search(r'<title>(.*?)</title>', body, re.DOTALL)
+    return title.group(1).strip() if title else None
+
+async def http_post(client, url, data=None, json_data=None, headers=None):
+    """POST form or JSON data following redirects, return the final AsyncResponse with its body read"""
+    req_headers = {"Accept": "text/html,application/json"}
+    body = None
+    if json_data is not None:
+        body = json.dumps(json_data)
+        req_headers["Content-Type"] = "application/json"
+    elif isinstance(data, dict):
+        body = urlencode(data)
+        req_headers["Content-Type"] = "application/x-www-form-urlencoded"
+    elif data:
+        body = data
+        req_headers["Content-Type"] = "text/plain"
+    req_headers.update(headers or {})
+    
+    async with await client.fetch("POST", url, req_headers, body) as resp:
+        await resp.read()
+        return resp
+
+async def try_download(client, url, path, directory='.'):
+    """Stream a file to disk, return its size, or None when it does not exist"""
+    filename = os.path.join(directory, os.path.basename(path))
+    async with await client.fetch("GET", urljoin(url, path)) as resp:
+        if resp.status != 200:
+            await resp.read()
+            return None
+        size = 0
+        try:
+            with open(filename, 'wb') as f:
+                async for piece in resp.iter_body():
+                    f.write(piece)
+                    size += len(piece)
+        except BaseException:
+            os.remove(filename)
+            raise
+    return size
+
+async def login(client, url, username, password):
+    """Log in to WordPress, return the session cookies or None"""
+    login_url = urljoin(url, "/wp-login.php")
+    async with await client.request("GET", login_url) as resp:
+        await resp.read()
+        cookies = resp.headers.cookies
+    
+    login_data = urlencode({
+        'log': username, 'pwd': password, 'wp-submit': 'Log In',
+        'redirect_to': urljoin(url, "/wp-admin/"), 'testcookie': '1'
+    })
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
+    if cookies:
+        headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in cookies.items())
+    async with await client.request("POST", login_url, headers, login_data) as resp:
+        await resp.read()
+        cookies.update(resp.headers.cookies)
+    
+    return cookies if any(name.startswith('wordpress_logged_in') for name in cookies) else None
+
+async def upload_file(client, url, cookies, local_file):
+    """Upload one file with an existing session, return the media URL or None"""
+    boundary = f"---------------------------{int(time.time())}"
+    filename = os.path.basename(local_file)
+    content_type = mimetypes.guess_type(local_file)[0] or 'application/octet-stream'
+    head = (f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="_wpnonce"\r\n\r\nwp_mock_nonce\r\n'
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="action"\r\n\r\nupload-attachment\r\n'
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n").encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    headers = {
+        "Cookie": "; ".join(f"{k}={v}" for k, v in cookies.items()),
+        "Content-Type": f"multipart/form-data; boundary={boundary}"
+    }
+    
+    with open(local_file, 'rb') as f:
+        async with await client.request(
+                "POST", urljoin(url, "/wp-admin/async-upload.php"), headers, [head, f, tail]) as resp:
+            text = await resp.text()
+    url_match = re.search(r'"url"\s*:\s*"([^"]+)"', text)
+    return url_match.group(1) if resp.status == 200 and url_match else None
+
+async def run_many(urls, mode='get', concurrency=100, per_host=8, timeout=30, directory='.'):
+    """Fetch many URLs concurrently, printing one result line each as it completes"""
+    client = AsyncClient(per_host=per_host, timeout=timeout)
+    slots = asyncio.Semaphore(concurrency)
+    failures = 0
+    
+    async def one(url):
+        nonlocal failures
+        async with slots:
+            try:
+                if mode == 'download':
+                    size = await try_download(client, url, httpclient.split_url(url)[3].split('?')[0], directory)
+                    result = f"{size} bytes" if size is not None else "not found"
+                else:
+                    title = await http_get(client, url)
+                    result = f"Title: {title}" if title else "No title found"
+            except Exception as e:
+                failures += 1
+                result = f"Error: {e!r}"
+            print(f"{url}\t{result}")
+    
+    try:
+        await asyncio.gather(*(one(url) for url in urls))
+    finally:
+        client.close()
+    return failures
+
+def run_sync(urls):
+    """The same GETs through the blocking httpclient path, one at a time"""
+    for url in urls:
+        with httpclient.request("GET", url) as resp:
+            resp.read()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="asyncio HTTP client for many URLs")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--urls', nargs='+', help='URLs to fetch')
+    source.add_argument('--url-file', help='File with one URL per line ("-" for stdin)')
+    parser.add_argument('--mode', choices=['get', 'download'], default='get',
+                        help='Print page titles (get) or save files (download)')
+    parser.add_argument('--concurrency', type=int, default=100, help='Requests in flight overall')
+    parser.add_argument('--per-host', type=int, default=8, help='Connections per host')
+    parser.add_argument('--timeout', type=float, default=30, help='Seconds per connect/read')
+    parser.add_argument('--compare-sync', action='store_true',
+                        help='Also time the same GETs through the blocking client and compare')
+    parser.add_argument('--trace', nargs='?', const='-', metavar='FILE',
+                        help='Print a timing waterfall of every request on stderr, or append JSON lines to FILE')
+    args = parser.parse_args(argv)
+    if args.trace:
+        httpclient.trace_to(args.trace)
+    
+    urls = args.urls
+    if args.url_file:
+        with (sys.stdin if args.url_file == '-' else open(args.url_file)) as f:
+            urls = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    
+    start = time.perf_counter()
+    failures = asyncio.run(run_many(urls, args.mode, args.concurrency, args.per_host, args.timeout))
+    elapsed = time.perf_counter() - start
+    print(f"async: {len(urls)} requests, {failures} failed, {elapsed:.2f}s, {len(urls) / elapsed:.1f} req/s",
+          file=sys.stderr)
+    
+    if args.compare_sync:
+        start = time.perf_counter()
+        run_sync(urls)
+        sync_elapsed = time.perf_counter() - start
+        print(f"sync:  {len(urls)} requests, {sync_elapsed:.2f}s, {len(urls) / sync_elapsed:.1f} req/s "
+              f"(async speed-up x{sync_elapsed / elapsed:.1f})", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
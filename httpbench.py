@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""Benchmark the clients end to end against the local WordPress test server"""
+
+import os, sys, json, time, socket, signal, threading, platform, tempfile, argparse, subprocess, tracemalloc
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+import httpclient, httpget, httppost, httpupload, httpdownload
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER_DIR = os.path.join(HERE, 'test_server')
+USER, PASSWORD = 'test', 'test123QWE@AD'
+UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+SCENARIOS = ['get', 'login', 'upload', 'download', 'receive', 'cli']
+
+# How a download body reaches the disk in the receive scenario: the whole body joined in memory,
+# streamed piece by piece, or received straight into a memory-mapped file
+RECEIVE_METHODS = ('join', 'stream', 'mmap')
+body_buffers = {}  # Receive method -> bytes objects made to carry the body in its last run
+
+def parse_size(text):
+    """'1K', '64M', '2G' or a plain number of bytes"""
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1:] if text[-1:] in UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * UNITS[unit])
+
+def size_label(size):
+    if not size:
+        return '-'
+    for unit in ('G', 'M', 'K'):
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return f"{size // UNITS[unit]}{unit}"
+    return str(size)
+
+def start_server(port, uploads_dir, perf=True):
+    """Run the test server in its own process group and wait until it accepts connections"""
+    # Uploads go to uploads_dir, not the server's own uploads directory
+    command = [sys.executable, 'local_wordpress_server.py', '--port', str(port), '--uploads-dir', uploads_dir]
+    command += ['--perf'] if perf else []
+    server = subprocess.Popen(command, cwd=SERVER_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                              start_new_session=True)
+    deadline = time.monotonic() + 20
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                break
+            time.sleep(0.2)
+    stop_server(server)
+    raise RuntimeError("Test server did not start")
+
+def stop_server(server):
+    try:
+        os.killpg(server.pid, signal.SIGTERM)  # Also stops the debug reloader's child
+    except ProcessLookupError:
+        pass
+    server.wait()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def make_payload(directory, size):
+    """A file of incompressible bytes, written in blocks so multi-GB payloads need no memory"""
+    path = os.path.join(directory, f"bench-{size_label(size)}.bin")
+    if not os.path.exists(path) or os.path.getsize(path) != size:
+        block = os.urandom(min(size, 1 << 20))
+        with open(path, 'wb') as f:
+            for start in range(0, size, len(block)):
+                f.write(block[:size - start])
+    return path
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, -(-len(values) * p // 100) - 1))]
+
+def reset_peak_rss():
+    """Start a new peak RSS measurement; False where that is not possible (not Linux)"""
+    # ru_maxrss only ever grows over the whole process: Linux can reset its own high-water mark instead
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    """Peak resident set size since reset_peak_rss()"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return round(int(line.split()[1]) / 1024, 1)
+
+def run_scenario(call, count, concurrency, payload=0):
+    """Run call() count times on concurrency threads; call returns True on success"""
+    latencies, failures = [], 0
+    
+    def timed(_):
+        start = time.perf_counter()
+        try:
+            ok = call()
+        except Exception:
+            ok = False
+        return ok, time.perf_counter() - start
+    
+    measured = reset_peak_rss()
+    start, cpu = time.perf_counter(), time.process_time()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for ok, latency in executor.map(timed, range(count)):
+            latencies.append(latency)
+            failures += not ok
+    elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu
+    
+    latencies.sort()
+    transferred = payload * (count - failures)
+    return {
+        'requests': count,
+        'failures': failures,
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(count / elapsed, 2),
+        'mb_per_second': round(transferred / elapsed / 1e6, 2) if payload else None,
+        'cpu_seconds_per_gb': round(cpu / (transferred / 1e9), 3) if transferred else None,
+        'latency_ms': {f"p{p}": round(percentile(latencies, p) * 1000, 2) for p in (50, 95, 99)},
+        'peak_rss_mb': peak_rss_mb() if measured else None
+    }
+
+def receive(file_url, method, workdir):
+    """Download file_url one way (see RECEIVE_METHODS), counting the body's bytes objects"""
+    # One file per thread: truncating a file another worker has mapped would crash it
+    filename = os.path.join(workdir, f"receive-{method}-{threading.get_ident()}.bin")
+    with httpclient.request("GET", file_url, {"Accept-Encoding": "identity"}) as resp:
+        if resp.status != 200:
+            resp.read()
+            return False
+        size = resp.direct_length
+        if method == 'mmap' and size:
+            body_buffers[method] = 0
+            return httpdownload.save_direct(resp, filename, size) == size
+        pieces = 0
+        with open(filename, 'wb') as f:
+            if method == 'join':
+                body = []
+                for piece in resp.iter_body():
+                    body.append(piece)
+                pieces = len(body) + 1  # Plus the joined copy
+                f.write(b''.join(body))
+            else:
+                for piece in resp.iter_body():
+                    f.write(piece)
+                    pieces += 1
+        body_buffers[method] = pieces
+    return True
+
+def start_daemon(path):
+    """Start `httpcli.py daemon` on a socket of its own and wait until it listens"""
+    daemon = subprocess.Popen([sys.executable, os.path.join(HERE, 'httpcli.py'), 'daemon', '--socket', path],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 20
+    while not os.path.exists(path):
+        if daemon.poll() is not None or time.monotonic() > deadline:
+            daemon.terminate()
+            raise RuntimeError("Client daemon did not start")
+        time.sleep(0.05)
+    return daemon
+
+def run_command(argv, env):
+    """Run a client as a new process, as a shell loop would"""
+    return subprocess.run([sys.executable] + argv, env=env, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL).returncode == 0
+
+def traced_peak_mb(call):
+    """Peak Python heap use during one call"""
+    tracemalloc.start()
+    try:
+        call()
+        return round(tracemalloc.get_traced_memory()[1] / (1 << 20), 2)
+    finally:
+        tracemalloc.stop()
+
+def scenarios(url, names, sizes, workdir):
+    """(name, payload size, callable) for every requested scenario and payload size"""
+    jar = httpclient.CookieJar(os.path.join(workdir, 'cookies.json'))
+    
+    def uploaded(payload):
+        """Upload the file once and return its path on the server"""
+        result = httpupload.http_upload_file(url, USER, PASSWORD, payload, jar)
+        if not result or not result['success']:
+            raise RuntimeError(f"Could not upload {payload} for the download benchmark")
+        return httpclient.split_url(urljoin(url, result['url']))[3]
+    
+    if 'get' in names:
+        yield 'get', 0, lambda: httpget.http_get(url) is not None
+    if 'login' in names:
+        yield 'login', 0, lambda: httppost.wordpress_login(url, USER, PASSWORD)[1] == 200
+    for size in sizes:
+        payload = make_payload(workdir, size)
+        if 'upload' in names:
+            yield 'upload', size, lambda: bool((httpupload.http_upload_file(url, USER, PASSWORD, payload, jar)
+                                                or {}).get('success'))
+        if 'download' in names or 'receive' in names:
+            # Upload the file once, then fetch it from where the server put it
+            remote = uploaded(payload)
+        if 'download' in names:
+            yield 'download', size, lambda: httpdownload.http_download_file(url, remote)
+        if 'receive' in names:
+            for method in RECEIVE_METHODS:
+                yield f"receive-{method}", size, lambda method=method: receive(urljoin(url, remote), method, workdir)
+    if 'cli' in names:
+        # A new process per GET: the bare interpreter, the old script, httpcli.py, and httpcli.py handing the
+        # command to its warm daemon
+        path = os.path.join(workdir, 'daemon.sock')
+        runs = [('python', ['-c', 'pass'], 'off'),
+                ('script', [os.path.join(HERE, 'httpget.py'), '--url', url], 'off'),
+                ('httpcli', [os.path.join(HERE, 'httpcli.py'), 'get', '--url', url], 'off'),
+                ('daemon', [os.path.join(HERE, 'httpcli.py'), 'get', '--url', url], 'on')]
+        daemon = start_daemon(path)
+        try:
+            for way, argv, mode in runs:
+                env = dict(os.environ, HTTP_DAEMON=mode, HTTP_DAEMON_SOCKET=path)
+                yield f"cli-{way}", 0, lambda argv=argv, env=env: run_command(argv, env)
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_file):
+    """Print the change in throughput and p95 latency against an earlier run"""
+    with open(baseline_file) as f:
+        baseline = {(r['scenario'], r['size'], r['concurrency']): r for r in json.load(f)['results']}
+    for r in results:
+        old = baseline.get((r['scenario'], r['size'], r['concurrency']))
+        if old:
+            rps = r['requests_per_second'] / old['requests_per_second'] - 1
+            p95 = r['latency_ms']['p95'] / old['latency_ms']['p95'] - 1 if old['latency_ms']['p95'] else 0
+            print(f"{r['scenario']:14} {size_label(r['size']):>5} x{r['concurrency']:<3} "
+                  f"req/s {rps:+.1%}  p95 {p95:+.1%}", file=sys.stderr)
+
+def benchmark(url, names, sizes, concurrencies, requests, max_bytes, workdir):
+    results = []
+    # The clients print progress for every call; keep it out of the report
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        for name, size, call in scenarios(url, names, sizes, workdir):
+            if not size:
+                call()  # Warm up: the first request pays for connecting and the server's lazy imports
+            for concurrency in concurrencies:
+                # Large payloads get fewer requests, but at least one per worker
+                count = max(concurrency, min(requests, max_bytes // size)) if size else requests
+                result = run_scenario(call, count, concurrency, size)
+                result = {'scenario': name, 'size': size, 'concurrency': concurrency, **result}
+                if name.startswith('receive-'):
+                    method = name.split('-', 1)[1]
+                    result['body_buffers'] = body_buffers.get(method)
+                    if concurrency == concurrencies[0]:
+                        result['traced_peak_mb'] = traced_peak_mb(call)
+                results.append(result)
+                cpu = f"  cpu {result['cpu_seconds_per_gb']} s/GB" if result['cpu_seconds_per_gb'] is not None else ''
+                print(f"{name:14} {size_label(size):>5} x{concurrency:<3} {result['requests_per_second']:>9} req/s "
+                      f"{result['mb_per_second'] or '':>9} MB/s  p50 {result['latency_ms']['p50']} ms  "
+                      f"p99 {result['latency_ms']['p99']} ms{cpu}", file=sys.stderr)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the HTTP clients against the local test server")
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS,
+                        help='What to measure (default: all)')
+    parser.add_argument('--sizes', nargs='+', default=['1K', '1M', '16M'],
+                        help='Upload/download payload sizes, e.g. 1K 64M 2G (default: 1K 1M 16M)')
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 8], help='Worker counts (default: 1 8)')
+    parser.add_argument('--requests', type=int, default=50, help='Requests per measurement (default: 50)')
+    parser.add_argument('--max-bytes', default='1G', help='Cap on bytes moved per measurement (default: 1G)')
+    parser.add_argument('--server-url', help='Benchmark a running server instead of starting one')
+    parser.add_argument('--dev-server', action='store_true',
+                        help='Start the test server in its default debug mode instead of --perf')
+    parser.add_argument('--output', default='bench.json', help='JSON results file (default: bench.json)')
+    parser.add_argument('--baseline', help='Earlier results file to compare against')
+    parser.add_argument('--trace', nargs='?', const='-', metavar='FILE',
+                        help='Print a timing waterfall of every request on stderr, or append JSON lines to FILE')
+    args = parser.parse_args()
+    if args.trace:
+        httpclient.trace_to(args.trace)
+    
+    sizes = [parse_size(size) for size in args.sizes]
+    output = os.path.abspath(args.output)
+    with tempfile.TemporaryDirectory(prefix='httpbench-') as workdir:
+        server = None
+        if not args.server_url:
+            port = free_port()
+            server = start_server(port, os.path.join(workdir, 'uploads'), not args.dev_server)
+        url = args.server_url or f"http://127.0.0.1:{port}/"
+        cwd = os.getcwd()
+        os.chdir(workdir)  # Downloads are saved in the working directory
+        try:
+            started = time.strftime('%Y-%m-%dT%H:%M:%S%z')
+            results = benchmark(url, args.scenarios, sizes, args.concurrency, args.requests,
+                                parse_size(args.max_bytes), workdir)
+        finally:
+            os.chdir(cwd)
+            if server:
+                stop_server(server)
+    
+    report = {
+        'revision': git_revision(),
+        'started': started,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'server': args.server_url or ('local debug' if args.dev_server else 'local perf'),
+        'results': results
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}", file=sys.stderr)
+    if args.baseline:
+        compare(results, args.baseline)
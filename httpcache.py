@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""On-disk HTTP cache: responses stored by URL, revalidated with their ETag / Last-Modified"""
+
+import os, json, mmap, time, hashlib, threading
+from email.utils import parsedate_to_datetime
+import httpclient
+
+CACHE_DIR = os.path.expanduser(os.environ.get('HTTP_CACHE_DIR', '~/.cache/http_client'))
+CACHE_SIZE = 256 << 20  # Bytes of stored bodies kept before the least recently used are evicted
+READ_BLOCK = 256 * 1024
+
+# Fields describing the transfer rather than the stored (decoded) body
+TRANSFER_FIELDS = {'connection', 'keep-alive', 'transfer-encoding', 'content-encoding', 'content-length',
+                   'set-cookie', 'date', 'age'}
+
+def http_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def fresh_until(headers, now):
+    """Time until which the response may be used without asking the server"""
+    directives = httpclient.cache_control(headers)
+    if 'no-cache' in directives:
+        return 0
+    max_age = str(directives.get('max-age', ''))
+    if max_age.isdigit():
+        age = headers.get('age', '')
+        return now + int(max_age) - (int(age) if age.isdigit() else 0)
+    expires = http_date(headers.get('expires'))
+    if expires is not None:
+        # Relative to the server clock, so a skewed local clock does not matter
+        return now + expires - (http_date(headers.get('date')) or now)
+    return 0
+
+def storable(resp, max_size):
+    """Whether a response is worth keeping: a full 200 that is fresh for a while or can be revalidated"""
+    length = resp.headers.get('content-length', '')
+    if resp.status != 200 or 'no-store' in httpclient.cache_control(resp.headers):
+        return False
+    if length.isdigit() and 'content-encoding' not in resp.headers and int(length) > max_size:
+        return False
+    return bool(resp.headers.get('etag') or resp.headers.get('last-modified')
+                or fresh_until(resp.headers, time.time()) > time.time())
+
+class CachedResponse(httpclient.ResponseBody):
+    """A stored response; the body is served from a memory map of the cache file"""
+    
+    def __init__(self, entry, path):
+        self.status, self.reason, self.from_cache = 200, 'OK', True
+        self.headers = httpclient.Headers(entry['fields'])
+        self.head = ("HTTP/1.1 200 OK\r\n" + "\r\n".join(f"{k}: {v}" for k, v in entry['fields'])).encode('iso-8859-1')
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.body = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+    
+    def iter_body(self):
+        for start in range(0, len(self.body), READ_BLOCK):
+            yield self.body[start:start + READ_BLOCK]
+    
+    @property
+    def cookies(self):
+        return {}
+    
+    def read(self):
+        if self._content is None:
+            self._content = self.body[:]
+        return self._content
+    
+    def close(self):
+        if self.file:
+            if self.body:
+                self.body.close()
+            self.file.close()
+            self.file = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+class HttpCache:
+    """Responses kept on disk per URL with their validators, evicted least recently used first"""
+    
+    def __init__(self, directory=CACHE_DIR, max_size=CACHE_SIZE):
+        self.directory, self.max_size = directory, max_size
+        self.index_path = os.path.join(directory, 'index.json')
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+    
+    def _read(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    def _write(self, index):
+        tmp = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp, self.index_path)
+    
+    def body_path(self, url):
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest())
+    
+    def _update(self, url, entry):
+        """Store or refresh an entry, then evict until the bodies fit in max_size"""
+        with self.lock:
+            index = self._read()
+            entry['used'] = time.time()
+            index[url] = entry
+            total = sum(e['size'] for e in index.values())
+            for old in sorted(index, key=lambda u: index[u]['used']):
+                if total <= self.max_size:
+                    break
+                total -= index.pop(old)['size']
+                try:
+                    os.remove(self.body_path(old))
+                except OSError:
+                    pass
+            self._write(index)
+        return index.get(url)
+    
+    def _serve(self, url, entry):
+        """A CachedResponse for the entry, or None if its body has gone"""
+        try:
+            return CachedResponse(self._update(url, entry), self.body_path(url))
+        except (OSError, TypeError, ValueError):
+            return None
+    
+    def _store(self, url, fields, pieces):
+        """Copy body pieces into the cache as the caller reads them; commit only a complete body"""
+        path = self.body_path(url)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        size, complete = 0, False
+        try:
+            with open(tmp, 'wb') as f:
+                for piece in pieces:
+                    f.write(piece)
+                    size += len(piece)
+                    yield piece
+            complete = True
+        finally:
+            if complete:
+                os.replace(tmp, path)
+                headers = httpclient.Headers(fields)
+                self._update(url, {'fields': fields, 'size': size, 'fresh_until': fresh_until(headers, time.time())})
+            elif os.path.exists(tmp):
+                os.remove(tmp)  # Stopped early or failed: never keep a partial body
+    
+    def request(self, url, headers=None, pool=None, max_redirects=httpclient.MAX_REDIRECTS):
+        """GET through the cache: a fresh copy costs no round trip, a stale one a conditional request"""
+        entry = self._read().get(url)
+        if entry and entry['fresh_until'] > time.time():
+            resp = self._serve(url, entry)
+            if resp:
+                return resp
+            entry = None
+        
+        req_headers = dict(headers or {})
+        if entry:
+            stored = httpclient.Headers(entry['fields'])
+            if stored.get('etag'):
+                req_headers['If-None-Match'] = stored['etag']
+            if stored.get('last-modified'):
+                req_headers['If-Modified-Since'] = stored['last-modified']
+        
+        # Redirects, remembered ones included, are followed up to max_redirects hops; the final response is stored
+        # under the URL asked for
+        resp = httpclient.fetch("GET", url, req_headers, pool=pool, max_redirects=max_redirects)
+        if resp.status == 304 and entry:
+            resp.read()
+            # Not modified: only the headers travelled; they may carry new freshness information
+            updates = {name for name, _ in resp.headers.fields if name not in TRANSFER_FIELDS}
+            fields = [f for f in entry['fields'] if f[0] not in updates]
+            fields += [f for f in resp.headers.fields if f[0] in updates]
+            merged = httpclient.Headers(fields + [f for f in resp.headers.fields if f[0] == 'age'])
+            entry.update(fields=fields, fresh_until=fresh_until(merged, time.time()))
+            cached = self._serve(url, entry)
+            if cached:
+                return cached
+            return httpclient.fetch("GET", url, headers, pool=pool, max_redirects=max_redirects)
+        
+        if storable(resp, self.max_size):
+            fields = [f for f in resp.headers.fields if f[0] not in TRANSFER_FIELDS]
+            resp._body = self._store(url, fields, resp._body)
+        return resp
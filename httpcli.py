@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""One entry point for all clients (httpcli.py get|post|upload|download|async ...), optionally through a warm daemon"""
+
+# Only os and sys at the top: a command imports just its own module, and a daemon run imports no client code at all
+import os, sys
+
+COMMANDS = {'get': 'httpget', 'post': 'httppost', 'upload': 'httpupload', 'download': 'httpdownload',
+            'async': 'httpasync'}
+DAEMON_SOCKET = os.path.expanduser(os.environ.get('HTTP_DAEMON_SOCKET', '~/.http_client.sock'))
+# Arguments that name this process's stdin or file descriptors, which a daemon cannot see
+LOCAL_ONLY = ('-', '/dev/stdin')
+LOCAL_ONLY_PREFIXES = ('/dev/fd/', '/proc/self/')
+# Settings the modules read once, at import or on first use: a daemon started with other values would quietly
+# use its own, so a command whose caller has different ones runs locally
+ENVIRONMENT = ('SSL_CERT_FILE', 'SSL_CERT_DIR', 'WP_COOKIE_JAR', 'HTTP_CACHE_DIR', 'WP_UPLOAD_INDEX', 'HTTP_STATS',
+               'HTTP_REDIRECT_CACHE')
+
+def usage(out=None):
+    print(f"usage: httpcli.py {{{','.join(COMMANDS)}}} [options]\n"
+          f"       httpcli.py daemon [--socket PATH] [--stop]\n\n"
+          f"Run `httpcli.py COMMAND --help` for a command's options. Commands go through the daemon listening on\n"
+          f"$HTTP_DAEMON_SOCKET (default: ~/.http_client.sock) when one is running; HTTP_DAEMON=off runs them here.",
+          file=out or sys.stderr)
+
+def run(argv):
+    """Run a command in this process, return its exit status"""
+    if not argv or argv[0] not in COMMANDS:
+        usage()
+        return 2
+    import importlib
+    module = importlib.import_module(COMMANDS[argv[0]])
+    sys.argv = [f"httpcli.py {argv[0]}"] + argv[1:]  # argparse takes its usage line from sys.argv[0]
+    try:
+        return module.main(argv[1:]) or 0
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else int(e.code is not None)
+
+def local_only(argv):
+    # The value of --option=value too, as in --data-file=-
+    values = [arg.partition('=')[2] if arg.startswith('--') and '=' in arg else arg for arg in argv]
+    return any(value in LOCAL_ONLY or value.startswith(LOCAL_ONLY_PREFIXES) for value in values)
+
+def environment():
+    """The ENVIRONMENT settings this process has, as NUL-separated NAME=value"""
+    return b'\0'.join(os.fsencode(f"{name}={os.environ[name]}") for name in ENVIRONMENT if name in os.environ)
+
+def connect(path):
+    """A socket connected to the daemon at path, or None if none is listening"""
+    # The C module is all a client needs; socket.py would add ~9 ms of imports (enum, selectors) to every run
+    import _socket
+    sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return sock
+    except OSError:
+        sock.close()
+        return None
+
+# Messages on the daemon socket are frames: a kind byte, the payload length in 4 bytes, then the payload.
+# The client sends ENV (its ENVIRONMENT settings) and RUN (working directory and arguments, NUL-separated),
+# or STOP; the daemon answers with STDOUT / STDERR frames as the command prints, then EXIT with the status,
+# or with LOCAL straight away if the settings differ from its own
+RUN, STOP, ENV, STDOUT, STDERR, EXIT, LOCAL = b'r', b's', b'v', b'o', b'e', b'x', b'l'
+
+def send_frame(sock, kind, payload=b''):
+    sock.sendall(kind + len(payload).to_bytes(4, 'big') + payload)
+
+def recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        piece = sock.recv(size - len(data))
+        if not piece:
+            raise EOFError("Connection closed")
+        data += piece
+    return bytes(data)
+
+def recv_frame(sock):
+    head = recv_exact(sock, 5)
+    return head[:1], recv_exact(sock, int.from_bytes(head[1:], 'big'))
+
+def run_remote(path, argv):
+    """Run a command in the daemon and relay its output; None if no daemon answers or it turns the command down"""
+    sock = connect(path)
+    if not sock:
+        return None
+    try:
+        send_frame(sock, ENV, environment())
+        send_frame(sock, RUN, b'\0'.join(os.fsencode(arg) for arg in [os.getcwd()] + argv))
+        while True:
+            try:
+                kind, payload = recv_frame(sock)
+            except (OSError, EOFError):
+                # The command may have done part of its work: never run it a second time here
+                print("Daemon đã ngắt kết nối giữa chừng", file=sys.stderr)
+                return 1
+            if kind == EXIT:
+                return int(payload)
+            if kind == LOCAL:
+                return None
+            out = sys.stdout if kind == STDOUT else sys.stderr
+            out.buffer.write(payload)
+            out.flush()
+    finally:
+        sock.close()
+
+class FrameWriter:
+    """Text stream that forwards each write to the client as a STDOUT or STDERR frame"""
+    
+    def __init__(self, sock, kind, lock):
+        self.sock, self.kind, self.lock = sock, kind, lock
+    
+    def write(self, text):
+        if text:
+            with self.lock:  # Worker threads print too
+                send_frame(self.sock, self.kind, text.encode())
+        return len(text)
+    
+    def flush(self):
+        pass
+    
+    def isatty(self):
+        return False
+
+def handle(conn):
+    """Run one client's command with its working directory and output; False when asked to stop"""
+    import threading, traceback
+    from contextlib import redirect_stdout, redirect_stderr
+    import httpclient
+    conn.settimeout(10)  # A client that connects and says nothing must not hold up the others
+    settings = b''
+    try:
+        kind, payload = recv_frame(conn)
+        if kind == ENV:
+            settings, (kind, payload) = payload, recv_frame(conn)
+    except (OSError, EOFError):
+        return True
+    conn.settimeout(None)
+    if kind == STOP:
+        send_frame(conn, EXIT, b'0')
+        return False
+    if settings != environment():
+        send_frame(conn, LOCAL)
+        return True
+    
+    client_cwd, *argv = [os.fsdecode(arg) for arg in payload.split(b'\0')]
+    lock, cwd = threading.Lock(), os.getcwd()
+    out, err = FrameWriter(conn, STDOUT, lock), FrameWriter(conn, STDERR, lock)
+    try:
+        with redirect_stdout(out), redirect_stderr(err):
+            try:
+                os.chdir(client_cwd)
+                code = run(argv)
+            except Exception:
+                traceback.print_exc()
+                code = 1
+        send_frame(conn, EXIT, str(code).encode())
+    except OSError:
+        pass  # The client went away
+    finally:
+        os.chdir(cwd)
+        httpclient.tracers.clear()  # --trace applies to one command only
+    return True
+
+def serve(path):
+    """Run commands sent to the Unix socket at path one at a time, keeping pools, TLS sessions and DNS warm"""
+    import socket, signal, importlib
+    running = connect(path)
+    if running:
+        running.close()
+        print(f"Daemon đã chạy tại {path}", file=sys.stderr)
+        return 1
+    if os.path.exists(path):
+        os.remove(path)  # Left behind by a daemon that did not exit cleanly
+    for module in COMMANDS.values():
+        importlib.import_module(module)
+    import httpclient
+    httpclient.ssl_context()
+    
+    server = socket.socket(socket.AF_UNIX)
+    umask = os.umask(0o077)  # Only this user may send commands
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen(64)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    print(f"Daemon đang lắng nghe tại {path}", file=sys.stderr)
+    try:
+        # One command at a time: commands share this process's stdout, stderr and working directory
+        running = True
+        while running:
+            conn, _ = server.accept()
+            with conn:
+                running = handle(conn)
+    finally:
+        server.close()
+        os.remove(path)
+    return 0
+
+def stop(path):
+    sock = connect(path)
+    if not sock:
+        print(f"Không có daemon nào tại {path}", file=sys.stderr)
+        return 1
+    try:
+        send_frame(sock, STOP)
+        recv_frame(sock)
+    finally:
+        sock.close()
+    return 0
+
+def daemon(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog='httpcli.py daemon',
+                                     description='Run httpcli.py commands sent to a Unix socket in one warm process')
+    parser.add_argument('--socket', default=DAEMON_SOCKET, help=f'Socket path (default: {DAEMON_SOCKET})')
+    parser.add_argument('--stop', action='store_true', help='Stop the daemon listening on the socket')
+    args = parser.parse_args(argv)
+    return stop(args.socket) if args.stop else serve(args.socket)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] in (['-h'], ['--help'], ['help']):
+        usage(sys.stdout)
+        return 0
+    if argv[:1] == ['daemon']:
+        return daemon(argv[1:])
+    if (argv[:1] and argv[0] in COMMANDS and os.environ.get('HTTP_DAEMON') != 'off'
+            and not local_only(argv) and os.path.exists(DAEMON_SOCKET)):
+        code = run_remote(DAEMON_SOCKET, argv)
+        if code is not None:
+            return code
+    return run(argv)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1499 @@
+#!/usr/bin/env python3
+"""Shared HTTP/1.1 client: a keep-alive connection pool used by all scripts"""
+
+import os, sys, json, stat, zlib, codecs, socket, select, time, random, atexit, threading
+from urllib.parse import urlparse, urljoin
+
+# ssl and email.utils are imported where they are first needed: together they are a large share of
+# a script's start-up time, and a plain-HTTP run without dates to parse never uses them
+
+USER_AGENT = "Custom-HTTP-Client"
+ACCEPT_ENCODING = "gzip, deflate"  # Sent by default; pass "identity" for byte-exact ranges
+DECODE_BLOCK = 64 * 1024  # Most decompressed output produced per input piece step
+SEND_BLOCK = 256 * 1024  # Read size for file parts that cannot use sendfile, and the largest request chunk
+RECV_BLOCK = 64 * 1024  # Body read size; readinto() doubles it up to RECV_BLOCK_MAX while reads come back full
+RECV_BLOCK_MAX = 1 << 20
+DNS_TTL = 60  # Seconds a getaddrinfo result is reused
+
+class ChunkedDecoder:
+    """Incremental decoder for chunked transfer encoding"""
+    SIZE, DATA, DATA_END, TRAILER, DONE = range(5)
+    
+    def __init__(self):
+        self.state, self.remaining, self.line = self.SIZE, 0, b''
+        self.unused = b''  # Bytes after the end of the body (the next pipelined response)
+    
+    @property
+    def done(self):
+        return self.state == self.DONE
+    
+    def _read_line(self, data, i):
+        """Buffer a CRLF-terminated line, return (line or None, next index)"""
+        # A CRLF split across two reads leaves a trailing CR in the buffer
+        if self.line.endswith(b'\r') and data[i:i + 1] == b'\n':
+            line, self.line = self.line[:-1], b''
+            return line, i + 1
+        end = data.find(b'\r\n', i)
+        if end == -1:
+            self.line += data[i:]
+            return None, len(data)
+        line, self.line = self.line + data[i:end], b''
+        return line, end + 2
+    
+    def feed(self, data):
+        """Yield decoded body pieces contained in the next slice of wire data"""
+        view, i = memoryview(data), 0
+        while i < len(data) and self.state != self.DONE:
+            if self.state == self.DATA:
+                n = min(self.remaining, len(data) - i)
+                yield view[i:i + n]
+                i += n
+                self.remaining -= n
+                if not self.remaining:
+                    self.state = self.DATA_END
+                continue
+            
+            line, i = self._read_line(data, i)
+            if line is None:
+                break
+            if self.state == self.SIZE:
+                self.remaining = int(line.split(b';')[0], 16)
+                self.state = self.DATA if self.remaining else self.TRAILER
+            elif self.state == self.DATA_END:
+                self.state = self.SIZE
+            elif not line:  # Empty line ends the trailer section
+                self.state = self.DONE
+                self.unused = data[i:]
+
+def split_url(url):
+    """Return (scheme, host, port, path) for a URL"""
+    parsed = urlparse(url)
+    port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+    path = (parsed.path or '/') + (f"?{parsed.query}" if parsed.query else '')
+    return parsed.scheme, parsed.hostname, port, path
+
+def host_header(scheme, host, port):
+    """Host header value, with the port only when it is not the default"""
+    return host if port == (443 if scheme == 'https' else 80) else f"{host}:{port}"
+
+class Headers(dict):
+    """Case-insensitive response headers; repeated fields such as Set-Cookie are all kept"""
+    
+    def __init__(self, fields=()):
+        super().__init__()
+        self.fields = []  # (lower-case name, value) in arrival order
+        for name, value in fields:
+            self.add(name, value)
+    
+    def add(self, name, value):
+        name = name.lower()
+        self.fields.append((name, value))
+        # Repeated fields combine with commas (RFC 9110), except Set-Cookie which cannot
+        if name in self and name != 'set-cookie':
+            value = f"{self[name]}, {value}"
+        self[name] = value
+    
+    # Stored under lower-case names; lookups lower-case the name they are given
+    def __getitem__(self, name):
+        return super().__getitem__(name.lower())
+    
+    def __contains__(self, name):
+        return super().__contains__(name.lower())
+    
+    def get(self, name, default=None):
+        return super().get(name.lower(), default)
+    
+    def get_all(self, name):
+        """Every value of a field, in order"""
+        name = name.lower()
+        return [value for field, value in self.fields if field == name]
+    
+    @property
+    def cookies(self):
+        """Name to value map of the cookies set by this response"""
+        cookies = {}
+        for value in self.get_all('set-cookie'):
+            name, sep, val = value.split(';', 1)[0].partition('=')
+            if sep:
+                cookies[name.strip()] = val.strip()
+        return cookies
+
+def parse_head(head):
+    """Parse a response header block (bytes) into (status, reason, Headers)"""
+    lines = head.split(b'\r\n')
+    parts = lines[0].split(b' ', 2)
+    status = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+    reason = parts[2].decode('iso-8859-1') if len(parts) > 2 else ''
+    headers = Headers()
+    for line in lines[1:]:
+        name, sep, value = line.partition(b':')
+        if sep:
+            headers.add(name.strip().decode('iso-8859-1'), value.strip().decode('iso-8859-1'))
+    return status, reason, headers
+
+class NoResponse(ConnectionError):
+    """The connection closed before any byte of the response arrived"""
+
+def read_headers(s, trace=None):
+    """Read only the header block, return (status, reason, head, headers, start of body)"""
+    buf, received = b'', False
+    while True:
+        end = buf.find(b'\r\n\r\n')
+        while end == -1:
+            try:
+                data = s.recv(8192)
+            except ConnectionResetError:
+                if received:
+                    raise
+                data = b''
+            if not data:
+                raise (ConnectionError if received else NoResponse)("Connection closed before response headers")
+            if trace and not received:
+                trace.mark('wait')  # First byte of the response
+            received = True
+            # Only the new bytes (plus a possibly split terminator) need searching
+            start = max(len(buf) - 3, 0)
+            buf += data
+            end = buf.find(b'\r\n\r\n', start)
+        
+        head, buf = buf[:end], buf[end + 4:]
+        status, reason, headers = parse_head(head)
+        # Interim responses (100 Continue, 103 Early Hints) precede the final one; 101 is left to the caller
+        if not 100 <= status < 200 or status == 101:
+            return status, reason, head, headers, buf
+
+def iter_body(s, headers, rest):
+    """Yield body pieces as they arrive, framed by chunked, Content-Length or close"""
+    # Bytes read past the body go back to a PipelinedSocket; a plain socket has none
+    chunks = iter(lambda: s.recv(RECV_BLOCK), b'')
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        decoder = ChunkedDecoder()
+        for data in _prepend(rest, chunks):
+            yield from decoder.feed(data)
+            if decoder.done:
+                _unread(s, decoder.unused)
+                return
+        raise ConnectionError("Connection closed inside chunked body")
+    
+    length = int(headers['content-length']) if 'content-length' in headers else None
+    if length == 0:
+        _unread(s, rest)
+        return
+    for data in _prepend(rest, chunks):
+        if length is not None:
+            _unread(s, data[length:])
+            data = data[:length]
+            length -= len(data)
+        yield data
+        if length == 0:
+            return
+    if length:
+        raise ConnectionError(f"Connection closed with {length} bytes missing")
+
+def _prepend(first, chunks):
+    if first:
+        yield first
+    yield from chunks
+
+def _unread(s, data):
+    if data and hasattr(s, 'unread'):
+        s.unread(data)
+
+class PipelinedSocket:
+    """Socket wrapper that keeps bytes read past one response for the next one"""
+    
+    def __init__(self, sock):
+        self.sock, self.buffer = sock, b''
+    
+    def recv(self, n):
+        if self.buffer:
+            data, self.buffer = self.buffer, b''
+            return data
+        return self.sock.recv(n)
+    
+    def unread(self, data):
+        self.buffer = bytes(data) + self.buffer
+
+class ContentDecoder:
+    """Streaming gzip/deflate decoder for a Content-Encoding"""
+    
+    def __init__(self, encoding):
+        self.raw_fallback = encoding == 'deflate'
+        # 32 + MAX_WBITS auto-detects gzip or zlib headers
+        self.obj = zlib.decompressobj(32 + zlib.MAX_WBITS if encoding != 'deflate' else zlib.MAX_WBITS)
+    
+    @staticmethod
+    def for_headers(headers):
+        encoding = headers.get('content-encoding', '').strip().lower()
+        return ContentDecoder(encoding) if encoding in ('gzip', 'x-gzip', 'deflate') else None
+    
+    def feed(self, data):
+        """Yield decompressed output in bounded blocks"""
+        while data:
+            try:
+                out = self.obj.decompress(data, DECODE_BLOCK)
+            except zlib.error:
+                # Some servers send "deflate" without the zlib wrapper
+                if not self.raw_fallback:
+                    raise
+                self.raw_fallback = False
+                self.obj = zlib.decompressobj(-zlib.MAX_WBITS)
+                continue
+            self.raw_fallback = False
+            if out:
+                yield out
+            data = self.obj.unconsumed_tail
+    
+    def flush(self):
+        return self.obj.flush()
+
+def decode_body(pieces, headers):
+    """Undo the Content-Encoding of a stream of body pieces"""
+    decoder = ContentDecoder.for_headers(headers)
+    if not decoder:
+        yield from pieces
+        return
+    for piece in pieces:
+        yield from decoder.feed(piece)
+    tail = decoder.flush()
+    if tail:
+        yield tail
+
+def content_charset(headers, default='utf-8'):
+    """Charset declared in Content-Type if Python knows it, else default"""
+    for param in headers.get('content-type', '').split(';')[1:]:
+        name, _, value = param.partition('=')
+        if name.strip().lower() == 'charset' and value.strip(' "\''):
+            try:
+                return codecs.lookup(value.strip(' "\'')).name
+            except LookupError:
+                break
+    return default
+
+class JsonStreamDecoder:
+    """Incremental JSON decoder: elements of a top-level array as each completes, any other document at the end"""
+    
+    def __init__(self, encoding='utf-8'):
+        self.text = codecs.getincrementaldecoder(encoding)()
+        self.parts, self.size = [], 0  # Text not yet decoded as JSON
+        self.array = None              # Unknown until the first character
+        self.separator = False         # An element was decoded, ',' or ']' comes next
+        self.retry_at = 0              # Pending size worth another attempt at an incomplete element
+        self.done = False
+        self.decoder = json.JSONDecoder()
+    
+    def feed(self, data):
+        """Yield the values completed by the next piece of body bytes"""
+        text = self.text.decode(data)
+        if text:
+            self.parts.append(text)
+            self.size += len(text)
+        yield from self._values(False)
+    
+    def flush(self):
+        """Yield what is left at the end of the body; raise ValueError if the document is incomplete"""
+        self.parts.append(self.text.decode(b'', final=True))
+        yield from self._values(True)
+        if not self.done:
+            raise ValueError("Incomplete JSON document")
+    
+    def _values(self, final):
+        if self.done:
+            return
+        if self.array is None:
+            text = ''.join(self.parts).lstrip()
+            if not text:
+                return
+            self.array = text.startswith('[')
+            self.parts = [text[1:] if self.array else text]
+            self.size = len(self.parts[0])
+        if not self.array:
+            if final:
+                self.done = True
+                yield json.loads(''.join(self.parts))
+            return
+        # An element split across pieces fails to decode; waiting for the pending text to double
+        # before trying again keeps a large element from being re-parsed on every piece
+        if self.size < self.retry_at and not final:
+            return
+        text, pos = ''.join(self.parts), 0
+        while True:
+            while pos < len(text) and text[pos] in ' \t\r\n':
+                pos += 1
+            if pos == len(text):
+                break
+            if self.separator or text[pos] == ']':
+                if text[pos] == ']':
+                    self.done = True
+                    pos += 1
+                    break
+                if text[pos] != ',':
+                    raise ValueError(f"Expected ',' or ']' in JSON array, got {text[pos]!r}")
+                self.separator = False
+                pos += 1
+                continue
+            try:
+                value, end = self.decoder.raw_decode(text, pos)
+            except ValueError:
+                if final:
+                    raise
+                self.retry_at = 2 * (len(text) - pos)
+                break
+            if not final and isinstance(value, (int, float)) and not isinstance(value, bool):
+                # A number is complete only once something other than number characters follows it
+                j = end
+                while j < len(text) and text[j] in '0123456789.eE+-':
+                    j += 1
+                if j == len(text):
+                    break
+            self.retry_at, self.separator, pos = 0, True, end
+            yield value
+        self.parts = [text[pos:]]
+        self.size = len(self.parts[0])
+
+def body_framing(method, status, head, headers, keep_alive=True):
+    """Headers that frame the body, and whether the connection survives it"""
+    keep_alive = keep_alive and head.startswith(b'HTTP/1.1') and \
+        'close' not in headers.get('connection', '').lower()
+    if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+        return {'content-length': '0'}, keep_alive
+    # Without chunked or Content-Length framing the body ends when the socket closes
+    if 'content-length' not in headers and 'chunked' not in headers.get('transfer-encoding', '').lower():
+        return headers, False
+    return headers, keep_alive
+
+# Connection setup counters; HTTP_STATS=1 prints them (and the time saved) at exit
+stats = {'dns_lookups': 0, 'dns_cached': 0, 'dns_seconds': 0.0, 'connects': 0, 'connect_seconds': 0.0,
+         'tls_full': 0, 'tls_full_seconds': 0.0, 'tls_resumed': 0, 'tls_resumed_seconds': 0.0,
+         'throttled': 0, 'retries': 0, 'retry_wait_seconds': 0.0, 'redirects': 0, 'redirects_remembered': 0}
+stats_lock = threading.Lock()
+
+def count(**increments):
+    with stats_lock:
+        for name, value in increments.items():
+            stats[name] += value
+
+def transport_stats():
+    """Snapshot of the counters plus the estimated time the DNS and TLS session caches saved"""
+    with stats_lock:
+        snapshot = {name: round(value, 6) for name, value in stats.items()}
+    lookup = snapshot['dns_seconds'] / snapshot['dns_lookups'] if snapshot['dns_lookups'] else 0
+    full = snapshot['tls_full_seconds'] / snapshot['tls_full'] if snapshot['tls_full'] else 0
+    resumed = snapshot['tls_resumed_seconds'] / snapshot['tls_resumed'] if snapshot['tls_resumed'] else 0
+    snapshot['dns_seconds_saved'] = round(snapshot['dns_cached'] * lookup, 6)
+    snapshot['tls_seconds_saved'] = round(snapshot['tls_resumed'] * max(full - resumed, 0), 6) if full else None
+    return snapshot
+
+if os.environ.get('HTTP_STATS'):
+    atexit.register(lambda: print(f"transport: {json.dumps(transport_stats())}", file=sys.stderr))
+
+tracers = []  # Callables given one event dict per finished request; tracing costs nothing while empty
+TRACE_PHASES = ('dns', 'connect', 'tls', 'send', 'wait', 'transfer')
+WATERFALL = {'dns': 'd', 'connect': 'c', 'tls': 't', 'send': 's', 'wait': '.', 'transfer': '='}
+
+class Trace:
+    """Phase timestamps and byte counts of one request, reported to the tracers when it ends"""
+    
+    def __init__(self, method, url):
+        self.method, self.url = method, url
+        self.wall, self.start = time.time(), time.perf_counter()
+        self.marks = {}
+        self.status, self.reused = None, False
+        self.bytes_sent = self.bytes_received = 0
+        self.attempt = 1  # Retries of a throttled or failed request are traced as further attempts
+        self.emitted = False
+    
+    def mark(self, phase):
+        """Record that a phase ended now"""
+        self.marks[phase] = time.perf_counter()
+    
+    def sent(self, conn, size):
+        self.mark('send')
+        self.reused = conn.requests > 0
+        self.bytes_sent = size
+    
+    def count_received(self, pieces):
+        for piece in pieces:
+            self.bytes_received += len(piece)
+            yield piece
+    
+    def emit(self, error=None):
+        """Report the request once: each phase's duration in ms, from the end of the one before"""
+        if self.emitted:
+            return
+        self.emitted = True
+        phases, last = {}, self.start
+        for phase in TRACE_PHASES:
+            if phase in self.marks:
+                phases[phase] = round((self.marks[phase] - last) * 1000, 3)
+                last = self.marks[phase]
+        event = {'method': self.method, 'url': self.url, 'status': self.status, 'start': round(self.wall, 6),
+                 'reused': self.reused, 'phases': phases, 'total_ms': round((last - self.start) * 1000, 3),
+                 'bytes_sent': self.bytes_sent, 'bytes_received': self.bytes_received, 'attempt': self.attempt,
+                 'error': repr(error) if error else None}
+        for tracer in list(tracers):
+            tracer(event)
+
+def new_trace(method, url):
+    """A Trace for a request if any tracer is installed, else None"""
+    return Trace(method, url) if tracers else None
+
+def print_waterfall(event, width=40):
+    """One line per request: the phases drawn to scale, then the numbers"""
+    total = event['total_ms'] or 1
+    bar, elapsed = '', 0
+    for phase, ms in event['phases'].items():
+        elapsed += ms
+        bar += WATERFALL[phase] * (round(elapsed / total * width) - len(bar))
+    timings = ' '.join(f"{phase} {ms:.1f}" for phase, ms in event['phases'].items())
+    print(f"{event['method']} {event['url']} {event['status'] or event['error']} [{bar:<{width}}] "
+          f"{event['total_ms']:.1f} ms ({timings}) sent {event['bytes_sent']} B, received {event['bytes_received']} B"
+          f"{' (reused)' if event['reused'] else ''}"
+          f"{' (attempt %d)' % event['attempt'] if event['attempt'] > 1 else ''}", file=sys.stderr)
+
+def trace_to(target):
+    """Install a tracer: '-' prints a waterfall line per request on stderr, a file name appends JSON lines"""
+    if target == '-':
+        tracer = print_waterfall
+    else:
+        out, lock = open(target, 'a', buffering=1), threading.Lock()
+        def tracer(event):
+            with lock:
+                out.write(json.dumps(event) + '\n')
+    tracers.append(tracer)
+    return tracer
+
+def is_tls(sock):
+    # An SSLSocket can only exist once something has imported ssl
+    ssl = sys.modules.get('ssl')
+    return ssl is not None and isinstance(sock, ssl.SSLSocket)
+
+def is_certificate_error(e):
+    ssl = sys.modules.get('ssl')
+    return ssl is not None and isinstance(e, ssl.SSLCertVerificationError)
+
+_ssl_context = None
+_ssl_lock = threading.Lock()
+
+def ssl_context():
+    """The process-wide client SSL context, so the CA bundle is loaded only once"""
+    # Extra trust roots (e.g. the test server's self-signed cert) come from SSL_CERT_FILE
+    global _ssl_context
+    with _ssl_lock:
+        if _ssl_context is None:
+            import ssl
+            _ssl_context = ssl.create_default_context()
+        return _ssl_context
+
+dns_cache = {}     # (host, port) -> (expiry, getaddrinfo result)
+tls_sessions = {}  # (host, port) -> SSLSession from the last connection, for abbreviated handshakes
+
+def resolve(host, port, trace=None):
+    """getaddrinfo for a TCP connection, cached for DNS_TTL seconds"""
+    cached = dns_cache.get((host, port))
+    if cached and cached[0] > time.monotonic():
+        count(dns_cached=1)
+        if trace:
+            trace.mark('dns')
+        return cached[1]
+    start = time.monotonic()
+    addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    count(dns_lookups=1, dns_seconds=time.monotonic() - start)
+    dns_cache[(host, port)] = (time.monotonic() + DNS_TTL, addresses)
+    if trace:
+        trace.mark('dns')
+    return addresses
+
+def open_socket(host, port, timeout=None, trace=None):
+    """Connect to the first reachable resolved address, like socket.create_connection"""
+    error = None
+    for family, kind, proto, _, address in resolve(host, port, trace):
+        sock = socket.socket(family, kind, proto)
+        try:
+            sock.settimeout(timeout)
+            start = time.monotonic()
+            sock.connect(address)
+            count(connects=1, connect_seconds=time.monotonic() - start)
+            if trace:
+                trace.mark('connect')
+            return sock
+        except OSError as e:
+            sock.close()
+            error = e
+    # The addresses may be out of date: resolve again next time
+    dns_cache.pop((host, port), None)
+    raise error or OSError(f"No addresses for {host}")
+
+class Connection:
+    """A persistent connection to one (scheme, host, port)"""
+    
+    def __init__(self, scheme, host, port, timeout=None, trace=None):
+        self.key = (scheme, host, port)
+        self.sock = open_socket(host, port, timeout, trace)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if scheme == 'https':
+            self.sock = self._handshake(host, port)
+            if trace:
+                trace.mark('tls')
+        self.last_used = time.monotonic()
+        self.requests = 0
+    
+    def _handshake(self, host, port):
+        """TLS handshake, resuming the last session with this host when there is one"""
+        sock = self.sock
+        try:
+            sock = ssl_context().wrap_socket(sock, server_hostname=host, do_handshake_on_connect=False,
+                                             session=tls_sessions.get((host, port)))
+            start = time.monotonic()
+            sock.do_handshake()
+        except BaseException:
+            sock.close()  # The raw socket, or the TLS socket that took over its descriptor
+            raise
+        if sock.session_reused:
+            count(tls_resumed=1, tls_resumed_seconds=time.monotonic() - start)
+        else:
+            count(tls_full=1, tls_full_seconds=time.monotonic() - start)
+        return sock
+    
+    def remember_session(self):
+        # TLS 1.3 tickets arrive after the handshake, so the session is taken once a response was read
+        session = getattr(self.sock, 'session', None)
+        if session is not None and session.has_ticket:
+            tls_sessions[self.key[1:]] = session
+    
+    def is_stale(self, idle_timeout):
+        """Idle for too long, or closed by the server while sitting in the pool"""
+        if time.monotonic() - self.last_used > idle_timeout:
+            return True
+        # An idle socket is only readable if the peer closed it (or sent junk)
+        try:
+            return bool(select.select([self.sock], [], [], 0)[0])
+        except (OSError, ValueError):
+            return True
+    
+    def close(self):
+        self.sock.close()
+
+class ConnectionPool:
+    """Per-(scheme, host, port) pool of idle keep-alive connections"""
+    
+    def __init__(self, max_per_host=4, idle_timeout=30, timeout=30, controller=None):
+        self.max_per_host, self.idle_timeout, self.timeout = max_per_host, idle_timeout, timeout
+        self.controller = controller  # Paces and retries the requests sent through the pool (AdaptiveController)
+        self.idle = {}    # key -> idle connections, most recently used last
+        self.active = {}  # key -> number of open connections (idle or in use)
+        self.cond = threading.Condition()
+    
+    def acquire(self, scheme, host, port, trace=None):
+        """Return an idle live connection, or open one once under the per-host limit"""
+        key = (scheme, host, port)
+        with self.cond:
+            while True:
+                idle = self.idle.get(key, [])
+                while idle:
+                    conn = idle.pop()
+                    if not conn.is_stale(self.idle_timeout):
+                        return conn
+                    self._discard(conn)
+                if self.active.get(key, 0) < self.max_per_host:
+                    self.active[key] = self.active.get(key, 0) + 1
+                    break
+                self.cond.wait()
+        
+        try:
+            return Connection(scheme, host, port, self.timeout, trace)
+        except BaseException:
+            with self.cond:
+                self.active[key] -= 1
+                self.cond.notify()
+            raise
+    
+    def release(self, conn, reuse=True):
+        """Give a connection back, keeping it only if it can carry another request"""
+        with self.cond:
+            conn.remember_session()
+            if reuse:
+                conn.last_used = time.monotonic()
+                conn.requests += 1
+                self.idle.setdefault(conn.key, []).append(conn)
+            else:
+                self._discard(conn)
+            self.cond.notify()
+    
+    def _discard(self, conn):
+        conn.close()
+        self.active[conn.key] -= 1
+    
+    def close(self):
+        """Close every idle connection"""
+        with self.cond:
+            for idle in self.idle.values():
+                for conn in idle:
+                    self._discard(conn)
+            self.idle.clear()
+
+THROTTLED = (429, 503)  # The server did not handle the request and asks for it to come later
+IDEMPOTENT = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+def retry_after(headers, now=None):
+    """Seconds the server asks to wait (Retry-After as seconds or an HTTP date), or None"""
+    value = headers.get('retry-after', '').strip()
+    if value.isdigit():
+        return float(value)
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - (now or time.time()), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+class AdaptiveController:
+    """Per-host request concurrency found by AIMD, with retries for throttled and failed requests
+    
+    Every success adds 1/limit to a host's limit (about one more request per round of responses).
+    A 429/503, a connection failure or a time to first byte well above the best seen so far cuts it,
+    at most once per round trip. Retry-After pauses the whole host. Only idempotent requests whose
+    body can be replayed are sent again; other methods only after a status in unsafe_retries (e.g.
+    429 for uploads, which the server refused before acting on them). Waits are jittered exponential
+    backoff; a Retry-After longer than max_wait is not waited for, the response is returned instead.
+    """
+    
+    def __init__(self, initial=4, minimum=1, maximum=64, retries=4, backoff=0.5, max_wait=300, adaptive=True,
+                 unsafe_retries=(), verbose=False):
+        self.initial, self.minimum, self.maximum = initial, minimum, maximum
+        self.retries, self.backoff, self.max_wait, self.adaptive = retries, backoff, max_wait, adaptive
+        self.unsafe_retries, self.verbose = unsafe_retries, verbose  # verbose: say on stderr why a retry waits
+        self.hosts = {}  # key -> limit, requests in flight, pause, latency and counters of one host
+        self.cond = threading.Condition()
+    
+    def _host(self, key):
+        if key not in self.hosts:
+            self.hosts[key] = {'limit': float(min(self.initial, self.maximum)), 'active': 0, 'paused_until': 0.0,
+                               'latency': None, 'best_latency': None, 'last_decrease': 0.0,
+                               'requests': 0, 'throttled': 0, 'errors': 0, 'retries': 0}
+        return self.hosts[key]
+    
+    def admit(self, key):
+        """Wait for a free slot under the host's limit and the end of any Retry-After pause"""
+        with self.cond:
+            host = self._host(key)
+            while True:
+                wait = host['paused_until'] - time.monotonic()
+                if wait <= 0 and (host['active'] < int(host['limit']) or not self.adaptive):
+                    host['active'] += 1
+                    return
+                self.cond.wait(wait if wait > 0 else None)
+    
+    def release(self, key):
+        with self.cond:
+            self.hosts[key]['active'] -= 1
+            self.cond.notify_all()
+    
+    def _decrease(self, host, factor):
+        # One cut per round trip: the responses already in flight report the same congestion
+        now = time.monotonic()
+        if now - host['last_decrease'] > (host['latency'] or 0):
+            host['limit'] = max(self.minimum, host['limit'] * factor)
+            host['last_decrease'] = now
+    
+    def observe(self, key, status=None, latency=None, headers=None):
+        """Adjust the host's limit after a response (status None: the request failed)"""
+        with self.cond:
+            host = self._host(key)
+            host['requests'] += 1
+            if status in THROTTLED or status is None:
+                host['throttled' if status else 'errors'] += 1
+                wait = retry_after(headers) if headers else None
+                if wait:
+                    host['paused_until'] = max(host['paused_until'], time.monotonic() + min(wait, self.max_wait))
+                self._decrease(host, 0.5)
+            elif latency is not None:
+                host['latency'] = latency if host['latency'] is None else 0.8 * host['latency'] + 0.2 * latency
+                host['best_latency'] = min(host['best_latency'] or latency, latency)
+                # Queueing at the server shows as a first byte much later than it used to arrive
+                if host['latency'] > 2 * host['best_latency'] + 0.05:
+                    self._decrease(host, 0.75)
+                else:
+                    host['limit'] = min(self.maximum, host['limit'] + 1 / host['limit'])
+            self.cond.notify_all()
+    
+    def delay(self, attempt, headers=None):
+        """Seconds to wait before the next attempt: Retry-After, or full-jitter exponential backoff
+        
+        None if Retry-After asks for longer than max_wait.
+        """
+        wait = retry_after(headers) if headers else None
+        if wait is not None:
+            return wait + random.uniform(0, self.backoff) if wait <= self.max_wait else None
+        return random.uniform(0, min(self.max_wait, self.backoff * 2 ** attempt))
+    
+    def request(self, method, url, prepared, pool):
+        """Send a prepared request under the host's limit, retrying it while that is allowed and useful"""
+        key, parts = prepared[:3], prepared[4]
+        files = [(part, part.tell()) for part in parts if is_regular_file(part)]
+        replay = replayable(parts)
+        for attempt in range(self.retries + 1):
+            self.admit(key)
+            start = time.monotonic()
+            try:
+                resp = send_prepared(method, url, prepared, pool, attempt + 1)
+            except BaseException as e:
+                self.release(key)
+                # A refused certificate does not get better by asking again
+                if not isinstance(e, OSError) or is_certificate_error(e):
+                    raise
+                self.observe(key)
+                if attempt == self.retries or method not in IDEMPOTENT or not replay:
+                    raise
+                wait = self.delay(attempt)
+                if self.verbose:
+                    print(f"{method} {url}: {e}, thử lại sau {wait:.1f} s (lần {attempt + 1}/{self.retries})",
+                          file=sys.stderr)
+            else:
+                self.observe(key, resp.status, time.monotonic() - start, resp.headers)
+                safe = method in IDEMPOTENT or resp.status in self.unsafe_retries
+                wait = self.delay(attempt, resp.headers) if resp.status in THROTTLED else None
+                if resp.status in THROTTLED:
+                    count(throttled=1)
+                if wait is None or attempt == self.retries or not replay or not safe:
+                    resp.on_close = lambda resp: self.release(key)
+                    return resp
+                if self.verbose:
+                    print(f"{method} {url}: {resp.status} {resp.reason}, thử lại sau {wait:.1f} s "
+                          f"(lần {attempt + 1}/{self.retries})", file=sys.stderr)
+                with resp:
+                    resp.read()  # Keep the connection for the next attempt
+                self.release(key)
+            with self.cond:
+                self.hosts[key]['retries'] += 1
+            count(retries=1, retry_wait_seconds=wait)
+            time.sleep(wait)
+            for f, pos in files:
+                f.seek(pos)
+    
+    def snapshot(self):
+        """Current state of every host, for progress lines and reports"""
+        with self.cond:
+            return {f"{scheme}://{host}:{port}": {
+                        'limit': round(state['limit'], 2), 'active': state['active'],
+                        'paused_for': round(max(state['paused_until'] - time.monotonic(), 0), 3),
+                        'latency_ms': round(state['latency'] * 1000, 2) if state['latency'] is not None else None,
+                        **{name: state[name] for name in ('requests', 'throttled', 'errors', 'retries')}}
+                    for (scheme, host, port), state in self.hosts.items()}
+
+# Standalone requests are not paced, and retry a couple of times without waiting long, saying so on stderr
+default_pool = ConnectionPool(controller=AdaptiveController(retries=2, max_wait=30, adaptive=False, verbose=True))
+
+class ResponseBody:
+    """Body accessors for a response with headers and read(): text and JSON, decoded once on first use"""
+    _content = _text = _json = None
+    
+    @property
+    def charset(self):
+        return content_charset(self.headers)
+    
+    @property
+    def content(self):
+        """The whole body as bytes"""
+        return self.read()
+    
+    @property
+    def text(self):
+        """The body decoded with the declared charset (UTF-8 if none)"""
+        if self._text is None:
+            self._text = self.read().decode(self.charset, errors='replace')
+        return self._text
+    
+    def json(self):
+        """The body parsed as JSON; UTF bodies are parsed from the bytes without a text copy"""
+        if self._json is None:
+            self._json = (json.loads(self.read() if self.charset.startswith('utf') else self.text),)
+        return self._json[0]
+    
+    def iter_json(self):
+        """Decode the body as it streams: each element of a top-level array, or the whole document"""
+        decoder = JsonStreamDecoder(self.charset)
+        for piece in [self._content] if self._content is not None else self.iter_body():
+            yield from decoder.feed(piece)
+        yield from decoder.flush()
+
+class Response(ResponseBody):
+    """Response read from a pooled connection; the body is streamed on demand"""
+    
+    def __init__(self, conn, pool, method, keep_alive=True, trace=None, sock=None):
+        # Without a pool the connection is not released here (pipelined responses share it)
+        self.conn, self.pool, self.trace = conn, pool, trace
+        sock = sock or conn.sock
+        self.status, self.reason, self.head, self.headers, rest = read_headers(sock, trace)
+        
+        framing, self.keep_alive = body_framing(method, self.status, self.head, self.headers, keep_alive)
+        pieces = iter_body(sock, framing, rest)
+        if trace:
+            trace.status = self.status
+            trace.bytes_received += len(self.head) + 4
+            pieces = trace.count_received(pieces)
+        self._body = self._decoded = decode_body(pieces, self.headers)
+        self.finished = False
+        self.on_close = None  # Called once with the response when it is closed
+        self.url, self.history = None, []  # Set by fetch(): the final URL and the redirects that led to it
+        
+        # An identity body of known length can be received straight into a caller's buffer (readinto)
+        length = framing.get('content-length', '')
+        plain = ('chunked' not in framing.get('transfer-encoding', '').lower()
+                 and not ContentDecoder.for_headers(self.headers))
+        self._sock, self._rest = sock, rest
+        self._length = int(length) if plain and length.isdigit() and hasattr(sock, 'recv_into') else None
+    
+    @property
+    def direct_length(self):
+        """Body size if readinto() can take the body, else None (encoded, chunked, or already wrapped)"""
+        return self._length if self._body is self._decoded else None
+    
+    def readinto(self, buffer, progress=None):
+        """Receive the whole body into a writable buffer of direct_length bytes, return its size
+        
+        The socket writes straight into slices of the buffer (recv_into), so no bytes object is made
+        for the body apart from what arrived with the headers. Call it before reading any of the body;
+        progress, if given, is called with the size of every read.
+        """
+        length = self.direct_length
+        if length is None:
+            raise ValueError("Body cannot be received directly")
+        with memoryview(buffer) as view:
+            if len(view) < length:
+                raise ValueError(f"Buffer too small for {length} bytes")
+            self._body = iter(())  # Whatever happens, the body is not there to iterate any more
+            pos = min(len(self._rest), length)
+            view[:pos] = self._rest[:pos]
+            if progress and pos:
+                progress(pos)
+            block = RECV_BLOCK
+            while pos < length:
+                n = self._sock.recv_into(view[pos:min(pos + block, length)])
+                if not n:
+                    raise ConnectionError(f"Connection closed with {length - pos} bytes missing")
+                if n == block:
+                    block = min(block * 2, RECV_BLOCK_MAX)
+                pos += n
+                if progress:
+                    progress(n)
+        self.finished = True
+        if self.trace:
+            self.trace.bytes_received += length
+            self.trace.mark('transfer')
+        self.close()
+        return length
+    
+    def iter_body(self):
+        """Yield body pieces; the connection goes back to the pool at the end"""
+        if self._content is not None:
+            yield self._content
+            return
+        for piece in self._body:
+            yield piece
+        self.finished = True
+        if self.trace:
+            self.trace.mark('transfer')
+        self.close()
+    
+    @property
+    def cookies(self):
+        return self.headers.cookies
+    
+    def read(self):
+        """Read the whole body; it is kept, so later calls (and .content, .text, .json()) do not read again"""
+        if self._content is None:
+            self._content = b''.join(self.iter_body())
+            self._body = iter(())
+        return self._content
+    
+    def close(self):
+        """Release the connection, dropping it if the body was not fully read"""
+        if self.on_close:
+            callback, self.on_close = self.on_close, None
+            callback(self)
+        if self.conn and self.pool:
+            self.pool.release(self.conn, self.finished and self.keep_alive)
+            self.conn = None
+            if self.trace:
+                self.trace.emit()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+def body_parts(body):
+    """Normalize a body to a list of bytes, open binary files and streams"""
+    if body is None:
+        return []
+    if isinstance(body, str):
+        return [body.encode()]
+    return list(body) if isinstance(body, (list, tuple)) else [body]
+
+def is_regular_file(part):
+    try:
+        return stat.S_ISREG(os.fstat(part.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError):
+        return False
+
+def part_length(part):
+    """Bytes left in a body part, None for a stream (pipe, file-like object, iterable)"""
+    if isinstance(part, (bytes, bytearray, memoryview)):
+        return len(part)
+    if is_regular_file(part):
+        return os.fstat(part.fileno()).st_size - part.tell()
+    return None
+
+def replayable(parts):
+    """Whether the body can be sent again after a failed attempt"""
+    return all(isinstance(part, (bytes, bytearray, memoryview)) or is_regular_file(part) for part in parts)
+
+def read_block(f, size=SEND_BLOCK):
+    """Up to size bytes from a file-like object; read1 hands over what a pipe has instead of waiting for more"""
+    return f.read1(size) if hasattr(f, 'read1') else f.read(size)
+
+def iter_part(part):
+    """The bytes of a stream part, read a block at a time"""
+    if isinstance(part, memoryview):
+        yield part.cast('B')  # Lengths below count bytes, whatever the view's item format
+    elif isinstance(part, (bytes, bytearray)):
+        yield part
+    elif hasattr(part, 'read'):
+        while block := read_block(part):
+            yield block
+    else:
+        for block in part:
+            yield block.encode() if isinstance(block, str) else block
+
+def send_file(sock, f):
+    """Send the rest of an open file without loading it into memory, return the bytes sent"""
+    if not is_tls(sock):
+        return sock.sendfile(f)
+    # TLS has to encrypt in user space: reuse one fixed-size buffer
+    buf = bytearray(SEND_BLOCK)
+    view = memoryview(buf)
+    sent = 0
+    while n := f.readinto(buf):
+        sock.sendall(view[:n])
+        sent += n
+    return sent
+
+def send_chunked(sock, parts):
+    """Send parts with chunked framing, return the bytes sent
+    
+    Small pieces from iterables are gathered into chunks of up to SEND_BLOCK bytes; regular files
+    are one chunk each and still go out with sendfile, and every read from a stream is one chunk, so
+    what a pipe has goes out at once. Nothing is read from a stream before the previous chunk was
+    handed to the socket, so a slow receiver holds back the producer instead of filling memory.
+    """
+    buf, sent = bytearray(), 0
+    
+    def send_chunk(data):
+        nonlocal sent
+        if data:
+            frame = b''.join((b'%x\r\n' % len(data), data, b'\r\n'))
+            sock.sendall(frame)
+            sent += len(frame)
+    
+    for part in parts:
+        if is_regular_file(part):
+            send_chunk(buf)
+            buf.clear()
+            size = part_length(part)
+            if size:
+                frame = b'%x\r\n' % size
+                sock.sendall(frame)
+                sent += len(frame) + send_file(sock, part) + 2
+                sock.sendall(b'\r\n')
+            continue
+        if hasattr(part, 'read'):
+            send_chunk(buf)
+            buf.clear()
+            while block := read_block(part):
+                send_chunk(block)
+            continue
+        for block in iter_part(part):
+            if len(buf) + len(block) > SEND_BLOCK:
+                send_chunk(buf)
+                buf.clear()
+            if len(block) >= SEND_BLOCK:
+                send_chunk(block)
+            else:
+                buf += block
+    send_chunk(buf)
+    sock.sendall(b'0\r\n\r\n')
+    return sent + 5
+
+def send_request(sock, head, parts, chunked=False):
+    """Send the request head and body parts; files go out with sendfile. Return the bytes sent"""
+    # Coalesce the head with a leading bytes part so small requests are one write
+    if parts and isinstance(parts[0], (bytes, bytearray)) and not chunked:
+        head, parts = head + parts[0], parts[1:]
+    sock.sendall(head)
+    if chunked:
+        return len(head) + send_chunked(sock, parts)
+    sent = len(head)
+    for part in parts:
+        if isinstance(part, (bytes, bytearray, memoryview)):
+            sock.sendall(part)
+            sent += len(part)
+        elif is_regular_file(part):
+            sent += send_file(sock, part)
+        else:
+            for block in iter_part(part):  # A stream sent with a Content-Length the caller gave
+                sock.sendall(block)
+                sent += len(block)
+    return sent
+
+def prepare_request(method, url, headers=None, body=None):
+    """Build the request head, return (scheme, host, port, head, body parts, keep_alive, chunked)"""
+    # body: bytes, str, an open binary file, a stream (pipe, file-like object, iterable of bytes)
+    # or a list of those; files are streamed, never read whole, and streams are sent chunked
+    scheme, host, port, path = split_url(url)
+    
+    # Fields by lower-case name: a caller's field replaces a default spelled any other way, in its place
+    fields = {"host": ("Host", host_header(scheme, host, port)), "user-agent": ("User-Agent", USER_AGENT),
+              "accept-encoding": ("Accept-Encoding", ACCEPT_ENCODING)}
+    fields.update((name.lower(), (name, value)) for name, value in (headers or {}).items())
+    parts = body_parts(body)
+    # Never both framings (RFC 9112 6.2): a caller's Transfer-Encoding keeps the length out of the head
+    if body is not None and "content-length" not in fields and "transfer-encoding" not in fields:
+        lengths = [part_length(part) for part in parts]
+        if None in lengths:
+            fields.setdefault("transfer-encoding", ("Transfer-Encoding", "chunked"))
+        else:
+            fields["content-length"] = ("Content-Length", str(sum(lengths)))
+    keep_alive = fields.get("connection", ('', ''))[1].lower() != 'close'
+    chunked = fields.get("transfer-encoding", ('', ''))[1].lower() == 'chunked'
+    
+    head = (f"{method} {path} HTTP/1.1\r\n" +
+            "".join(f"{k}: {v}\r\n" for k, v in fields.values()) + "\r\n").encode()
+    return scheme, host, port, head, parts, keep_alive, chunked
+
+def request(method, url, headers=None, body=None, pool=None):
+    """Send a request over a pooled keep-alive connection and return the Response"""
+    pool = pool or default_pool
+    prepared = prepare_request(method, url, headers, body)
+    if pool.controller:
+        return pool.controller.request(method, url, prepared, pool)
+    return send_prepared(method, url, prepared, pool)
+
+def stale_connection(error, sent):
+    """Whether a request that failed on a reused connection can go again on another one"""
+    # Only if the server cannot have acted on it: the send failed, or the connection closed without a byte
+    # of response. Never after a timeout: the server may still be working on the request
+    return not isinstance(error, socket.timeout) and (sent is None or isinstance(error, NoResponse))
+
+def send_prepared(method, url, prepared, pool, attempt=1):
+    """Send a prepared request once, on another connection if a reused one turns out to be closed"""
+    scheme, host, port, head, parts, keep_alive, chunked = prepared
+    # Remember file positions so a retry can send the same bytes again (a stream cannot be)
+    files = [(part, part.tell()) for part in parts if is_regular_file(part)]
+    retry = replayable(parts)
+    trace = new_trace(method, url)
+    if trace:
+        trace.attempt = attempt
+    
+    while True:
+        try:
+            conn = pool.acquire(scheme, host, port, trace)
+        except BaseException as e:
+            if trace:
+                trace.emit(e)
+            raise
+        sent = None
+        try:
+            sent = send_request(conn.sock, head, parts, chunked)
+            if trace:
+                trace.sent(conn, sent)
+            return Response(conn, pool, method, keep_alive, trace)
+        except OSError as e:
+            pool.release(conn, False)
+            # The server may close an idle connection just as we reuse it: try another one
+            if not conn.requests or not retry or not stale_connection(e, sent):
+                if trace:
+                    trace.emit(e)
+                raise
+            for f, pos in files:
+                f.seek(pos)
+
+MAX_REDIRECTS = 10
+REDIRECTS = (301, 302, 303, 307, 308)
+PERMANENT_REDIRECTS = (301, 308)  # Cacheable: later requests for the URL may go straight to the target
+BODY_HEADERS = {'content-type', 'content-length', 'transfer-encoding'}
+CREDENTIAL_HEADERS = {'authorization', 'cookie'}  # Not passed on to another origin
+REDIRECT_CACHE = os.environ.get('HTTP_REDIRECT_CACHE')  # JSON file keeping 301/308 targets across runs
+REDIRECT_CACHE_SIZE = 1024
+
+class TooManyRedirects(Exception):
+    """More redirects than allowed, usually a loop"""
+
+def cache_control(headers):
+    """Cache-Control directives as a dict (directives without a value map to True)"""
+    directives = {}
+    for item in headers.get('cache-control', '').split(','):
+        name, sep, value = item.strip().partition('=')
+        if name:
+            directives[name.lower()] = value.strip('"') if sep else True
+    return directives
+
+class RedirectCache:
+    """Targets of permanent (301/308) redirects by URL, in memory and, given a path, in a JSON file"""
+    
+    def __init__(self, path=None, max_entries=REDIRECT_CACHE_SIZE):
+        self.path = os.path.expanduser(path) if path else None
+        self.max_entries = max_entries
+        self.entries = None  # url -> [status, target, expiry time or None], read from the file on first use
+        self.lock = threading.Lock()
+    
+    def _entries(self):
+        if self.entries is None:
+            self.entries = {}
+            if self.path:
+                try:
+                    with open(self.path) as f:
+                        self.entries = json.load(f)
+                except (OSError, ValueError):
+                    pass
+        return self.entries
+    
+    def _save(self):
+        if self.path:
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp, self.path)
+    
+    def lookup(self, url):
+        """(status, target) remembered for url, or None"""
+        with self.lock:
+            entry = self._entries().get(url)
+            if entry and entry[2] is not None and entry[2] <= time.time():
+                del self.entries[url]
+                entry = None
+        return (entry[0], entry[1]) if entry else None
+    
+    def store(self, url, status, target, headers):
+        """Remember a permanent redirect, for as long as its Cache-Control allows"""
+        directives = cache_control(headers)
+        max_age = str(directives.get('max-age', ''))
+        if 'no-store' in directives or 'no-cache' in directives or max_age == '0':
+            return
+        expires = time.time() + int(max_age) if max_age.isdigit() else None
+        with self.lock:
+            entries = self._entries()
+            entries.pop(url, None)
+            entries[url] = [status, target, expires]
+            while len(entries) > self.max_entries:
+                del entries[next(iter(entries))]  # Oldest first
+            self._save()
+    
+    def forget(self, url):
+        with self.lock:
+            if self._entries().pop(url, None) is not None:
+                self._save()
+
+permanent_redirects = RedirectCache(REDIRECT_CACHE)
+
+def redirect_method(method, status):
+    """Method of the request that follows a redirect, and whether it still carries the body"""
+    # 307/308 repeat the request as it was; 303 asks for a GET, and so, after a POST, do 301/302 in practice
+    if status == 303 and method != 'HEAD' or status in (301, 302) and method == 'POST':
+        return 'GET', False
+    return method, True
+
+def parse_cookie_header(value):
+    pairs = (item.strip().partition('=') for item in value.split(';'))
+    return {name: val for name, sep, val in pairs if sep}
+
+class RedirectChain:
+    """The redirect rules of fetch() apart from the I/O, so the async client follows them the same way
+    
+    next_request() gives the (method, url, headers, body) to send, hopping over remembered redirects, and
+    done(resp) takes the response: True if it is the final one, otherwise the caller drains it (so its
+    connection can be reused) and sends the next request.
+    """
+    
+    def __init__(self, method, url, headers=None, body=None, max_redirects=MAX_REDIRECTS, cookies=None, memo=None):
+        self.first = (method, url, headers, body)
+        self.max_redirects, self.cookies = max_redirects, cookies
+        self.memo = permanent_redirects if memo is None else memo
+        self.origin = split_url(url)[:3]
+        parts = body_parts(body)
+        # Where each file starts, so a 307/308 can send the same bytes again (a stream cannot be)
+        self.files = [(part, part.tell()) for part in parts if is_regular_file(part)]
+        self.can_resend, self.sent = replayable(parts), False
+        self._start()
+    
+    def _start(self):
+        self.method, self.url, self.headers, self.body = self.first
+        self.history, self.remembered = [], []
+    
+    def _hop(self, status, target):
+        if len(self.history) == self.max_redirects:
+            raise TooManyRedirects(f"More than {self.max_redirects} redirects from {self.first[1]}")
+        self.history.append((status, self.url, target))
+        count(redirects=1)
+        self.method, keep_body = redirect_method(self.method, status)
+        if not keep_body and self.body is not None:
+            self.body = None
+            self.headers = {k: v for k, v in (self.headers or {}).items() if k.lower() not in BODY_HEADERS}
+        self.url = target
+    
+    def next_request(self):
+        while self.max_redirects:
+            hop = self.memo.lookup(self.url)
+            if not hop:
+                break
+            self.remembered.append(self.url)
+            count(redirects_remembered=1)
+            self._hop(*hop)
+        
+        headers = dict(self.headers or {})
+        if split_url(self.url)[:3] != self.origin:
+            headers = {k: v for k, v in headers.items() if k.lower() not in CREDENTIAL_HEADERS}
+        stored = self.cookies.for_url(self.url) if self.cookies is not None else None
+        if stored:
+            merged = {**parse_cookie_header(headers.get('Cookie', '')), **stored}
+            headers['Cookie'] = "; ".join(f"{k}={v}" for k, v in merged.items())
+        if self.body is not None:
+            if self.sent:
+                for f, pos in self.files:
+                    f.seek(pos)
+            self.sent = True
+        return self.method, self.url, headers, self.body
+    
+    def done(self, resp):
+        """Whether resp ends the chain; the final response gets .url and .history"""
+        if self.cookies is not None:
+            self.cookies.update(self.url, resp.headers)
+        status, location = resp.status, resp.headers.get('location')
+        if status in REDIRECTS and location:
+            target = urljoin(self.url, location)
+            stuck = redirect_method(self.method, status)[1] and self.body is not None and not self.can_resend
+            if self.max_redirects and not stuck:
+                if status in PERMANENT_REDIRECTS:
+                    self.memo.store(self.url, status, target, resp.headers)
+                self._hop(status, target)
+                return False
+        elif self.remembered and status in (404, 410) and (not self.sent or self.can_resend):
+            # A remembered target has gone: forget the shortcuts and start again from the first URL
+            for url in self.remembered:
+                self.memo.forget(url)
+            self._start()
+            return False
+        resp.url, resp.history = self.url, self.history
+        return True
+
+def fetch(method, url, headers=None, body=None, pool=None, max_redirects=MAX_REDIRECTS, cookies=None, memo=None):
+    """Send a request and follow its redirects, return the final Response
+    
+    Each hop's method follows the status (see redirect_method); a body that has to go again is re-read from
+    its files, but a stream cannot be, so its redirect is returned as it is. Set-Cookie from every hop goes
+    into cookies (a SessionCookies) and the matching cookies go out with the next hop, while Authorization
+    and the caller's Cookie header only go to the first URL's origin. A hop to the same origin reuses the
+    connection the drained redirect gave back to the pool. 301/308 targets are kept in memo (default:
+    permanent_redirects), so later requests for those URLs skip the round trip.
+    
+    The Response's url is the final URL and its history lists (status, url, target) for every redirect,
+    remembered ones included. max_redirects=0 returns a redirect as it is; more hops than max_redirects
+    raise TooManyRedirects.
+    """
+    chain = RedirectChain(method, url, headers, body, max_redirects, cookies, memo)
+    while True:
+        resp = request(*chain.next_request(), pool)
+        try:
+            if chain.done(resp):
+                return resp
+            resp.read()  # Drained, so the connection goes back to the pool for a same-origin next hop
+        except BaseException:
+            resp.close()
+            raise
+
+PIPELINE_DEPTH = 16  # GETs sent ahead of the response being read
+
+def pipeline(urls, headers=None, pool=None, depth=PIPELINE_DEPTH):
+    """GET urls of one origin over one connection with up to depth requests in flight
+    
+    Yields (url, Response) in request order, each url once. Whatever is left of a body when the
+    next response is wanted gets read and dropped. Requests whose responses never started before
+    the connection failed are sent again on a new connection.
+    """
+    pool = pool or default_pool
+    pending = list(urls)
+    while pending:
+        prepared = [prepare_request("GET", url, headers) for url in pending]
+        scheme, host, port = prepared[0][:3]
+        conn = pool.acquire(scheme, host, port)
+        sock, reuse = PipelinedSocket(conn.sock), False
+        sent = answered = 0
+        try:
+            while answered < len(pending):
+                # Top the pipe up in one write once half of the requests in flight have been answered
+                if sent - answered <= depth // 2 and sent < len(pending):
+                    end = min(answered + depth, len(pending))
+                    conn.sock.sendall(b''.join(p[3] for p in prepared[sent:end]))
+                    sent = end
+                resp = Response(conn, None, "GET", prepared[answered][5], sock=sock)
+                # Handed to the caller: never requested again, even if the rest of its body fails to arrive
+                answered += 1
+                yield pending[answered - 1], resp
+                for _ in resp._body:
+                    pass
+                if not resp.keep_alive:
+                    break
+            reuse = answered == len(pending) and resp.keep_alive
+        except OSError:
+            # A reused connection may have been closed by the server before it saw anything
+            if not answered and not conn.requests:
+                raise
+        finally:
+            pool.release(conn, reuse)
+        pending = pending[answered:]
+
+COOKIE_JAR = os.path.expanduser(os.environ.get('WP_COOKIE_JAR', '~/.wp_http_cookies.json'))
+
+def parse_set_cookie(value):
+    """Parse a Set-Cookie value into a dict with name, value, path and expires"""
+    pairs = value.split(';')
+    name, _, val = pairs[0].partition('=')
+    cookie = {'name': name.strip(), 'value': val.strip(), 'path': '/', 'expires': None}
+    max_age = None
+    for attr in pairs[1:]:
+        k, _, v = attr.strip().partition('=')
+        k = k.lower()
+        if k == 'path' and v.startswith('/'):
+            cookie['path'] = v
+        elif k == 'max-age' and v.lstrip('-').isdigit():
+            max_age = int(v)
+        elif k == 'expires':
+            from email.utils import parsedate_to_datetime
+            try:
+                cookie['expires'] = parsedate_to_datetime(v).timestamp()
+            except (TypeError, ValueError):
+                pass
+    # Max-Age takes precedence over Expires
+    if max_age is not None:
+        cookie['expires'] = time.time() + max_age
+    return cookie
+
+def path_matches(cookie_path, path):
+    """RFC 6265 path-match of a request path against a cookie's Path"""
+    return path == cookie_path or path.startswith(cookie_path) and \
+        (cookie_path.endswith('/') or path[len(cookie_path)] == '/')
+
+class CookieJar:
+    """Cookies persisted on disk per (site, user), honouring expiry and Path, found again only with the password
+    
+    Each session is stored with a salted scrypt hash of the password that logged it in, so another password
+    never picks it up and the file does not make the password cheap to guess.
+    """
+    
+    def __init__(self, path=COOKIE_JAR):
+        self.path = path
+        self.lock = threading.Lock()
+    
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    def _write(self, data):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+    
+    @staticmethod
+    def _password_hash(password, salt):
+        import hashlib
+        return hashlib.scrypt(password.encode(), salt=bytes.fromhex(salt), n=1 << 14, r=8, p=1, dklen=32).hex()
+    
+    def _session(self, data, site, user, password):
+        """The stored session of this site and user if it was made with password, else None"""
+        entry = data.get(f"{user}@{site}")
+        # Entries without a password hash come from older versions and are never used
+        if not isinstance(entry, dict) or not entry.get('salt'):
+            return None
+        import hmac
+        return entry if hmac.compare_digest(entry['scrypt'], self._password_hash(password, entry['salt'])) else None
+    
+    def load(self, site, user, password):
+        """Unexpired cookies stored for this site and user, if they were made with password"""
+        now = time.time()
+        entry = self._session(self._read(), site, user, password)
+        return [c for c in entry['cookies'] if c['expires'] is None or c['expires'] > now] if entry else []
+    
+    def update(self, site, user, set_cookies, password):
+        """Merge Set-Cookie values into the stored cookies; expired ones delete"""
+        with self.lock:
+            data = self._read()
+            entry = self._session(data, site, user, password)
+            if not entry:
+                salt = os.urandom(16).hex()
+                entry = {'salt': salt, 'scrypt': self._password_hash(password, salt), 'cookies': []}
+            cookies = {(c['name'], c['path']): c for c in entry['cookies']}
+            for value in set_cookies:
+                cookie = parse_set_cookie(value)
+                cookies.pop((cookie['name'], cookie['path']), None)
+                if cookie['expires'] is None or cookie['expires'] > time.time():
+                    cookies[(cookie['name'], cookie['path'])] = cookie
+            entry['cookies'] = list(cookies.values())
+            data[f"{user}@{site}"] = entry
+            self._write(data)
+    
+    def forget(self, site, user):
+        """Drop the stored session for this site and user"""
+        with self.lock:
+            data = self._read()
+            # Also user@site#digest, the key of a session stored by an older version
+            keys = [key for key in data if key.partition('#')[0] == f"{user}@{site}"]
+            for key in keys:
+                del data[key]
+            if keys:
+                self._write(data)
+    
+    @staticmethod
+    def for_path(cookies, path):
+        """Name to value map of the cookies sent for a request path"""
+        # Sorted by Path length so the most specific cookie wins a name clash
+        matching = sorted((c for c in cookies if path_matches(c['path'], path)), key=lambda c: len(c['path']))
+        return {c['name']: c['value'] for c in matching}
+
+class SessionCookies:
+    """Cookies set during one session, kept per host and Path and sent back with the requests they match"""
+    # Host-only: the Domain attribute is not honoured, so a cookie only goes back to the host that set it
+    
+    def __init__(self):
+        self.cookies = {}   # (host, name, path) -> parsed cookie
+        self.received = []  # Every Set-Cookie value in arrival order (for CookieJar.update)
+        self.lock = threading.Lock()
+    
+    def update(self, url, headers):
+        """Take in the Set-Cookie fields of a response from url; expired ones delete"""
+        host = split_url(url)[1]
+        with self.lock:
+            for value in headers.get_all('set-cookie'):
+                self.received.append(value)
+                cookie = parse_set_cookie(value)
+                key = (host, cookie['name'], cookie['path'])
+                self.cookies.pop(key, None)
+                if cookie['expires'] is None or cookie['expires'] > time.time():
+                    self.cookies[key] = cookie
+    
+    def for_url(self, url):
+        """Name to value map of the cookies sent with a request for url"""
+        _, host, _, path = split_url(url)
+        now = time.time()
+        with self.lock:
+            cookies = [c for (h, _, _), c in self.cookies.items()
+                       if h == host and (c['expires'] is None or c['expires'] > now)]
+        return CookieJar.for_path(cookies, path.partition('?')[0])
+    
+    def values(self):
+        """Name to value map of every cookie held"""
+        with self.lock:
+            return {c['name']: c['value'] for c in self.cookies.values()}
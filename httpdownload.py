@@ -1,37 +1,19 @@
 #!/usr/bin/env python3
 
-import socket, ssl, os, argparse
-from urllib.parse import urlparse
-from contextlib import closing
-
-def decode_chunked(data):
-    """Decode chunked transfer encoding"""
-    result = bytearray()
-    i = 0
-    
-    while i < len(data):
-        line_end = data.find(b'\r\n', i)
-        if line_end == -1:
-            break
-            
-        try:
-            chunk_size = int(data[i:line_end].split(b';')[0], 16)
-        except ValueError:
-            break
-        
-        if chunk_size == 0:
-            break
-            
-        chunk_start = line_end + 2
-        chunk_end = chunk_start + chunk_size
-        
-        if chunk_end <= len(data):
-            result.extend(data[chunk_start:chunk_end])
-            i = chunk_end + 2  # Skip CRLF
-        else:
-            break
-            
-    return bytes(result)
+import os, re, sys, json, mmap, time, argparse, tempfile, threading
+from contextlib import contextmanager
+from urllib.parse import urljoin, urlsplit
+import httpclient
+
+MIN_SEGMENT_SIZE = 1 << 20  # Smaller ranges are not worth an extra connection
+STATE_INTERVAL = 4 << 20    # Bytes written between updates of the resume sidecar
+
+# Per-site memo of the month directory format that worked: 'padded' (/2023/05/) or 'unpadded' (/2023/5/)
+month_formats = {}
+
+# Read once at import, while no other thread can be changing it: finished downloads get the usual permissions
+UMASK = os.umask(0)
+os.umask(UMASK)
 
 def get_file_type(path):
     """Determine file type based on extension"""
@@ -44,81 +26,487 @@ def get_file_type(path):
         return "tài liệu"
     return "dữ liệu"
 
-def try_download(url, path):
-    """Attempt to download file"""
-    parsed = urlparse(url)
-    host, port = parsed.hostname, parsed.port or (443 if parsed.scheme == 'https' else 80)
-    secure = parsed.scheme == 'https'
-    file_type = get_file_type(path)
-    
-    with closing(socket.socket()) as s:
-        try:
-            if secure:
-                s = ssl.create_default_context().wrap_socket(s, server_hostname=host)
-            s.connect((host, port))
-            
-            s.sendall(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n"
-                      f"User-Agent: Custom-HTTP-Client\r\nConnection: close\r\n\r\n".encode())
-            
-            resp = b''.join(iter(lambda: s.recv(8192), b''))
-            
-            if b"HTTP/1." in resp:
-                header_end = resp.find(b'\r\n\r\n')
-                if header_end != -1:
-                    headers = resp[:header_end].decode('utf-8', errors='replace')
-                    body = resp[header_end + 4:]
-                    
-                    # Handle chunked encoding
-                    if "Transfer-Encoding: chunked" in headers:
-                        body = decode_chunked(body)
-                    
-                    # Check for success
-                    if "200 OK" in headers:
-                        print(f"Kích thước file {file_type}: {len(body)} bytes")
-                        
-                        # Save file
-                        filename = os.path.basename(path)
-                        with open(filename, 'wb') as f:
-                            f.write(body)
-                        print(f"File saved as: {filename}")
-                        return True
-            
-            return False
-                
-        except Exception as e:
-            print(f"Error: {e}")
+def preallocate(f, size):
+    """Reserve size bytes for the file; real blocks where possible, so a full disk fails here and not in a mapping"""
+    if hasattr(os, 'posix_fallocate'):
+        os.posix_fallocate(f.fileno(), 0, size)
+    else:
+        f.truncate(size)
+
+@contextmanager
+def replacing(filename):
+    """A new temporary file beside filename to write into; it replaces filename if the block succeeds"""
+    # Never written under the final name: another download of the same name may be mapping its own file
+    fd, tmp = tempfile.mkstemp(prefix=f".{os.path.basename(filename)}.", suffix='.tmp',
+                               dir=os.path.dirname(filename) or '.')
+    os.close(fd)
+    try:
+        yield tmp
+        os.chmod(tmp, 0o666 & ~UMASK)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def save_direct(resp, filename, size, progress=None):
+    """Map the preallocated file and receive the body straight into it"""
+    with open(filename, 'w+b') as f:
+        preallocate(f, size)
+        with mmap.mmap(f.fileno(), size) as mapped:
+            return resp.readinto(mapped, progress)
+
+def save_stream(resp, filename, progress=None):
+    """Write the body to disk as it arrives, return its size"""
+    # progress, if given, is called with the size of every piece written
+    # A plain body of known length skips the intermediate bytes objects altogether
+    if getattr(resp, 'direct_length', None):
+        return save_direct(resp, filename, resp.direct_length, progress)
+    size = 0
+    with open(filename, 'wb') as f:
+        if getattr(resp, 'from_cache', False):
+            f.write(resp.body)  # Straight from the memory-mapped cache file
+            if progress:
+                progress(len(resp.body))
+            return len(resp.body)
+        for piece in resp.iter_body():
+            f.write(piece)
+            size += len(piece)
+            if progress:
+                progress(len(piece))
+    return size
+
+def probe(file_url, pool=None):
+    """HEAD the file, return its size if the server accepts byte ranges"""
+    # Ranges and lengths refer to the encoded bytes, so ask for the file as-is
+    with httpclient.fetch("HEAD", file_url, {"Accept-Encoding": "identity"}, pool=pool) as resp:
+        resp.read()
+        length = resp.headers.get('content-length', '')
+        if resp.status == 200 and 'bytes' in resp.headers.get('accept-ranges', '') and length.isdigit():
+            return int(length)
+    return None
+
+def fetch_range(file_url, mapped, start, end, pool, progress=None):
+    """Fetch bytes start..end into their slice of the mapped file"""
+    headers = {"Range": f"bytes={start}-{end}", "Accept-Encoding": "identity"}
+    with httpclient.fetch("GET", file_url, headers, pool=pool) as resp:
+        if resp.status != 206 or not resp.headers.get('content-range', '').startswith(f"bytes {start}-{end}/"):
+            resp.read()
+            raise ConnectionError(f"Range {start}-{end} not honoured (status {resp.status})")
+        with memoryview(mapped)[start:end + 1] as view:
+            if resp.direct_length == len(view):
+                resp.readinto(view, progress)
+                return
+            pos = 0
+            for piece in resp.iter_body():
+                view[pos:pos + len(piece)] = piece
+                pos += len(piece)
+                if progress:
+                    progress(len(piece))
+            if pos != len(view):
+                raise ConnectionError(f"Range {start}-{end} ended after {pos} bytes")
+
+def download_segmented(file_url, filename, size, segments, progress=None, pool=None):
+    """Fetch byte ranges concurrently over separate connections into one mapping of a preallocated file"""
+    # In a shared pool the ranges queue for the per-host connections like any other request
+    segments = min(segments, pool.max_per_host) if pool else segments
+    step = -(-size // segments)
+    ranges = [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+    
+    from concurrent.futures import ThreadPoolExecutor
+    own_pool = pool is None
+    pool = pool or httpclient.ConnectionPool(max_per_host=len(ranges))
+    try:
+        with open(filename, 'w+b') as f:
+            preallocate(f, size)
+            with mmap.mmap(f.fileno(), size) as mapped, ThreadPoolExecutor(len(ranges)) as executor:
+                futures = [executor.submit(fetch_range, file_url, mapped, start, end, pool, progress)
+                           for start, end in ranges]
+                for future in futures:
+                    future.result()
+    finally:
+        if own_pool:
+            pool.close()
+
+def load_state(filename, file_url):
+    """Return the saved partial-download state for filename if it is for file_url"""
+    try:
+        with open(filename + '.part.json') as f:
+            state = json.load(f)
+        if state.get('url') == file_url and os.path.exists(filename + '.part'):
+            return state
+    except (OSError, ValueError):
+        pass
+    return None
+
+def save_state(filename, state):
+    with open(filename + '.part.json', 'w') as f:
+        json.dump(state, f)
+
+def validator(headers):
+    """Validator usable in If-Range: a strong ETag, else Last-Modified"""
+    etag = headers.get('etag', '')
+    return etag if etag and not etag.startswith('W/') else headers.get('last-modified')
+
+def download_resumable(file_url, filename, pool=None, progress=None):
+    """Download into filename.part, continuing from the sidecar state; return size or None"""
+    part = filename + '.part'
+    state = load_state(filename, file_url)
+    
+    # Continue only if the server can tell us whether the file changed since
+    ranged = bool(state and state['received'] and state.get('validator'))
+    headers = {"Accept-Encoding": "identity"}  # Byte offsets must match the file on disk
+    if ranged:
+        headers.update({"Range": f"bytes={state['received']}-", "If-Range": state['validator']})
+    
+    with httpclient.fetch("GET", file_url, headers, pool=pool) as resp:
+        content_range = resp.headers.get('content-range', '')
+        if resp.status == 206 and ranged and content_range.startswith(f"bytes {state['received']}-"):
+            offset = state['received']
+            print(f"Resuming from byte {offset}")
+        elif resp.status == 416 and ranged and content_range == f"bytes */{state['received']}":
+            resp.read()  # The previous run had already received everything
+            offset = None
+        elif resp.status == 200:
+            if state:
+                print("File changed on server, restarting download")
+            offset = 0
+        else:
+            resp.read()
+            return None
+        
+        if offset is not None:
+            state = {'url': file_url, 'received': offset, 'validator': validator(resp.headers)}
+            save_state(filename, state)
+            with open(part, 'r+b' if offset else 'wb') as f:
+                f.truncate(offset)
+                f.seek(offset)
+                saved = offset
+                try:
+                    for piece in resp.iter_body():
+                        f.write(piece)
+                        state['received'] += len(piece)
+                        if progress:
+                            progress(len(piece))
+                        if state['received'] - saved >= STATE_INTERVAL:
+                            f.flush()
+                            save_state(filename, state)
+                            saved = state['received']
+                finally:
+                    # The sidecar never claims more than what reached the file
+                    f.flush()
+                    save_state(filename, state)
+    
+    os.replace(part, filename)
+    os.remove(filename + '.part.json')
+    return state['received']
+
+def fetch_file(file_url, filename, segments=1, resume=False, cache=None, pool=None, progress=None):
+    """Download file_url into filename, return its size or None if the server does not serve it"""
+    # Split large files into ranges when the server supports them
+    size = probe(file_url, pool) if segments > 1 and not resume else None
+    if resume:
+        # Keep partial data on disk so an interrupted transfer can be continued
+        return download_resumable(file_url, filename, pool, progress)
+    if size is not None and size >= 2 * MIN_SEGMENT_SIZE:
+        with replacing(filename) as tmp:
+            download_segmented(file_url, tmp, size, min(segments, size // MIN_SEGMENT_SIZE), progress, pool)
+        return size
+    
+    # Redirects are followed, and a permanent one is remembered so the next download goes straight there
+    with (cache.request(file_url, pool=pool) if cache else httpclient.fetch("GET", file_url, pool=pool)) as resp:
+        if resp.status != 200:
+            resp.read()  # Drain the error page so the connection can be reused
+            return None
+        
+        # Save file as the body arrives
+        with replacing(filename) as tmp:
+            return save_stream(resp, tmp, progress)
+
+def try_download(url, path, segments=1, resume=False, cache=None):
+    """Attempt to download file, streaming the body straight to disk"""
+    filename = os.path.basename(urlsplit(path).path)
+    file_type = get_file_type(filename)
+    
+    try:
+        size = fetch_file(urljoin(url, path), filename, segments, resume, cache)
+        if size is None:
             return False
+        
+        print(f"Kích thước file {file_type}: {size} bytes")
+        print(f"File saved as: {filename}")
+        return True
+    
+    except Exception as e:
+        print(f"Error: {e}")
+        return False
 
-def http_download_file(url, remote_file):
+def month_variant(path):
+    """The path with the upload month zero-padded or unpadded, or None"""
+    match = re.match(r'^(.*/uploads/\d{4}/)(\d{1,2})(/.+)$', path)
+    if not match:
+        return None
+    prefix, month, rest = match.groups()
+    if len(month) == 1:  # Add leading zero
+        return f"{prefix}{month.zfill(2)}{rest}"
+    if month.startswith('0'):  # Remove leading zero
+        return f"{prefix}{month[1]}{rest}"
+    return None
+
+def month_format(path):
+    match = re.search(r'/uploads/\d{4}/(\d{1,2})/', path)
+    return 'padded' if len(match.group(1)) == 2 else 'unpadded'
+
+def find_path(url, candidates, pool=None):
+    """HEAD every candidate concurrently, return the first found (False if none, None if unknown)"""
+    def head(path):
+        with httpclient.fetch("HEAD", urljoin(url, path), pool=pool) as resp:
+            resp.read()
+            return path, resp.status
+    
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    statuses = []
+    with ThreadPoolExecutor(len(candidates)) as executor:
+        for future in as_completed([executor.submit(head, path) for path in candidates]):
+            try:
+                path, status = future.result()
+            except (OSError, httpclient.TooManyRedirects):
+                status = None
+            if status == 200:
+                return path
+            statuses.append(status)
+    # Only a clean "not found" everywhere settles it; otherwise fall back to plain GETs
+    return False if all(status in (404, 410) for status in statuses) else None
+
+def candidate_paths(url, remote_file, pool=None):
+    """Paths to try for remote_file, most likely first (handles month format differences)"""
+    variant = month_variant(remote_file)
+    site = urljoin(url, '/')
+    if variant and site in month_formats:
+        # Go straight to the month format this site used before, the other one is a fallback
+        return [variant, remote_file] if month_formats[site] == month_format(variant) else [remote_file, variant]
+    if variant:
+        # Probe both spellings at once, then fetch only the one that exists
+        found = find_path(url, [remote_file, variant], pool)
+        return [found] if found else [] if found is False else [remote_file, variant]
+    return [remote_file]
+
+def remember_path(url, path):
+    """Remember the month format of a path that worked for this site"""
+    if month_variant(path):
+        month_formats[urljoin(url, '/')] = month_format(path)
+
+def http_download_file(url, remote_file, segments=1, resume=False, cache=None):
     """Download file with normalized path"""
     # Ensure path starts with slash
     if not remote_file.startswith('/'):
         remote_file = '/' + remote_file
     
-    # Try original path
-    if try_download(url, remote_file):
-        return True
-    
     # Try alternate paths (handle month format differences)
-    if '/uploads/' in remote_file:
-        parts = remote_file.split('/')
-        if len(parts) >= 5 and parts[3].isdigit():
-            if len(parts[3]) == 1:  # Add leading zero
-                parts[3] = parts[3].zfill(2)
-                if try_download(url, '/'.join(parts)):
-                    return True
-            elif parts[3].startswith('0'):  # Remove leading zero
-                parts[3] = parts[3].lstrip('0')
-                if try_download(url, '/'.join(parts)):
-                    return True
+    for path in candidate_paths(url, remote_file):
+        if try_download(url, path, segments, resume, cache):
+            remember_path(url, path)
+            return True
     
     print(f"Không tồn tại file {get_file_type(remote_file)}")
     return False
 
-if __name__ == "__main__":
+def read_manifest(manifest):
+    """Remote paths or absolute URLs, one per line ("-" for stdin); blank lines and # comments skipped"""
+    with (sys.stdin if manifest == '-' else open(manifest)) as f:
+        entries = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    return list(dict.fromkeys(entries))
+
+class Progress:
+    """Aggregate bytes and files of a bulk download, reported on stderr while it runs"""
+    
+    def __init__(self, files, controller=None):
+        self.files, self.done, self.failed, self.bytes = files, 0, 0, 0
+        self.controller = controller
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        # Redraw one line on a terminal, print a line now and then into a log
+        self.tty = sys.stderr.isatty()
+        self.thread = threading.Thread(target=self._report, args=(1 if self.tty else 10,), daemon=True)
+        self.thread.start()
+    
+    def add(self, size):
+        with self.lock:
+            self.bytes += size
+    
+    def finished(self, result):
+        with self.lock:
+            self.done += 1
+            self.failed += not result['success']
+        if not result['success']:
+            self.print(f"{result['file']} FAILED: {result['error']}", '\n')
+    
+    def line(self):
+        with self.lock:
+            done, failed, size = self.done, self.failed, self.bytes
+        elapsed = time.monotonic() - self.start
+        # Files still to go at the rate files have been finishing so far
+        eta = (self.files - done) * elapsed / done if done else None
+        eta = time.strftime('%H:%M:%S', time.gmtime(eta)) if eta is not None else '--:--:--'
+        line = (f"[{done}/{self.files}] {failed} failed  {size / 1e6:.1f} MB  "
+                f"{size / elapsed / 1e6 if elapsed else 0:.2f} MB/s  ETA {eta}")
+        # The concurrency the controller settled on per site, and how often it was pushed back
+        for site, state in (self.controller.snapshot() if self.controller else {}).items():
+            line += f"  {site} x{state['limit']:g} {state['throttled']} throttled"
+        return line
+    
+    def print(self, text, end):
+        print(f"\r\033[K{text}" if self.tty else text, end=end, file=sys.stderr, flush=True)
+    
+    def _report(self, interval):
+        while not self.stopped.wait(interval):
+            self.print(self.line(), '' if self.tty else '\n')
+    
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.print(self.line(), '\n')
+
+def entry_target(url, entry):
+    """Site and remote path of a manifest entry: an absolute URL names its own site, a path is relative to url"""
+    parts = urlsplit(entry)
+    if parts.scheme:
+        return urljoin(entry, '/'), parts.path + (f"?{parts.query}" if parts.query else '')
+    return url, entry if entry.startswith('/') else '/' + entry
+
+def local_name(path, keep_paths):
+    """File name for a remote path; a query string (?token=...) is not part of it"""
+    path = urlsplit(path).path
+    return path.lstrip('/') if keep_paths else os.path.basename(path)
+
+def numbered(name, copy):
+    root, ext = os.path.splitext(name)
+    return f"{root}-{copy}{ext}"
+
+def number_duplicates(url, entries, keep_paths):
+    """Copy numbers for entries that would be saved under a name an earlier entry already takes, by index"""
+    names = [local_name(entry_target(url, entry)[1], keep_paths) for entry in entries]
+    taken, seen, copies = set(names), set(), {}
+    for i, name in enumerate(names):
+        if name in seen:
+            copy = 2
+            while numbered(name, copy) in taken:
+                copy += 1
+            taken.add(numbered(name, copy))
+            copies[i] = copy
+        seen.add(name)
+    return copies
+
+def download_entry(url, entry, directory, keep_paths, segments, resume, cache, pool, progress, copy=None):
+    """Download one manifest entry with the month format fallback, return a result dict"""
+    result = {'file': entry, 'success': False, 'url': None, 'saved_as': None, 'error': None, 'bytes': 0,
+              'seconds': 0.0, 'renamed': bool(copy)}
+    start = time.monotonic()
+    url, remote_file = entry_target(url, entry)
+    
+    try:
+        for path in candidate_paths(url, remote_file, pool):
+            name = local_name(path, keep_paths)
+            filename = os.path.join(directory, numbered(name, copy) if copy else name)
+            os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+            try:
+                size = fetch_file(urljoin(url, path), filename, segments, resume, cache, pool, progress.add)
+            except Exception as e:
+                result['error'] = str(e)
+                continue
+            if size is not None:
+                remember_path(url, path)
+                result.update(success=True, url=urljoin(url, path), saved_as=filename, bytes=size, error=None)
+                break
+        else:
+            result['error'] = result['error'] or "Not found"
+    except Exception as e:
+        result['error'] = str(e)
+    
+    result['seconds'] = round(time.monotonic() - start, 3)
+    progress.finished(result)
+    return result
+
+def bulk_download(url, entries, directory='.', workers=8, per_host=4, keep_paths=False, segments=1, resume=False,
+                  cache=None, retries=4):
+    """Download many files over a bounded worker pool, at most per_host connections to any one site"""
+    # The pool blocks a worker whose site is at its limit until one of that site's connections is free;
+    # below that, the controller finds how many requests each site takes and retries throttled ones
+    controller = httpclient.AdaptiveController(initial=min(2, per_host), maximum=per_host, retries=retries)
+    pool = httpclient.ConnectionPool(max_per_host=per_host, controller=controller)
+    progress = Progress(len(entries), controller)
+    # Entries that share a file name would overwrite each other: later ones get a numbered name (a-2.jpg)
+    copies = number_duplicates(url, entries, keep_paths)
+    if copies:
+        progress.print(f"{len(copies)} mục trùng tên file, lưu với tên đánh số", '\n')
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    results = []
+    try:
+        with ThreadPoolExecutor(workers) as executor:
+            futures = [executor.submit(download_entry, url, entry, directory, keep_paths, segments, resume, cache,
+                                       pool, progress, copies.get(i)) for i, entry in enumerate(entries)]
+            for future in as_completed(futures):
+                results.append(future.result())
+    finally:
+        progress.stop()
+        pool.close()
+    
+    elapsed = time.monotonic() - progress.start
+    total = sum(r['bytes'] for r in results)
+    return {
+        'files': len(results),
+        'succeeded': sum(r['success'] for r in results),
+        'failed': sum(not r['success'] for r in results),
+        'bytes': total,
+        'seconds': round(elapsed, 3),
+        'files_per_second': round(len(results) / elapsed, 2) if elapsed else None,
+        'mb_per_second': round(total / elapsed / 1e6, 2) if elapsed else None,
+        'sites': controller.snapshot(),
+        'failures': [r for r in results if not r['success']],
+        'renamed': [r for r in results if r['renamed']],
+        'results': results
+    }
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description="HTTP file download client")
     parser.add_argument('--url', required=True, help='Base URL')
-    parser.add_argument('--remote-file', required=True, help='Path to file')
-    args = parser.parse_args()
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--remote-file', help='Path to file')
+    source.add_argument('--manifest', help='File listing remote paths or URLs, one per line ("-" for stdin)')
+    parser.add_argument('--output-dir', default='.', help='Where bulk downloads are saved (default: current directory)')
+    parser.add_argument('--keep-paths', action='store_true',
+                        help='Save bulk downloads under their remote path instead of just the file name')
+    parser.add_argument('--workers', type=int, default=8, help='Concurrent downloads in manifest mode (default: 8)')
+    parser.add_argument('--per-host', type=int, default=4, help='Connections per site in manifest mode (default: 4)')
+    parser.add_argument('--summary', help='Write the manifest JSON report to this file instead of stdout')
+    parser.add_argument('--retries', type=int, default=4,
+                        help='Attempts after a 429/503 or a failed connection in manifest mode (default: 4)')
+    parser.add_argument('--segments', type=int, default=1,
+                        help='Parallel byte-range connections for large files (default: 1)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Keep partial data in a .part file and continue an interrupted download')
+    parser.add_argument('--cache', action='store_true', help='Keep a local copy and revalidate it on later runs')
+    parser.add_argument('--cache-dir', help='HTTP cache directory (default: $HTTP_CACHE_DIR or ~/.cache/http_client)')
+    parser.add_argument('--trace', nargs='?', const='-', metavar='FILE',
+                        help='Print a timing waterfall of every request on stderr, or append JSON lines to FILE')
+    args = parser.parse_args(argv)
+    if args.trace:
+        httpclient.trace_to(args.trace)
     
-    http_download_file(args.url, args.remote_file)
+    cache = None
+    if args.cache:
+        import httpcache
+        cache = httpcache.HttpCache(args.cache_dir or httpcache.CACHE_DIR)
+    if args.remote_file:
+        http_download_file(args.url, args.remote_file, args.segments, args.resume, cache)
+    else:
+        summary = bulk_download(args.url, read_manifest(args.manifest), args.output_dir, args.workers, args.per_host,
+                                args.keep_paths, args.segments, args.resume, cache, args.retries)
+        if args.summary:
+            with open(args.summary, 'w') as f:
+                json.dump(summary, f, indent=2)
+        else:
+            print(json.dumps(summary, indent=2))
+
+if __name__ == "__main__":
+    main()
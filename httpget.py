@@ -1,33 +1,103 @@
 #!/usr/bin/env python3
 
-import socket, ssl, re, argparse
-from urllib.parse import urlparse
-from contextlib import closing
+import re, sys, time, argparse, threading
+import httpclient
 
-def http_get(url):
-    parsed = urlparse(url)
-    host, path = parsed.hostname, parsed.path or '/'
-    port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+def read_title(resp, whole=False):
+    """Read the body up to the end of its <title> (or whole) and return the title, '' if there is none"""
+    body = bytearray()
+    for piece in resp.iter_body():
+        start = max(len(body) - 7, 0)
+        body += piece
+        if body.find(b'</title>', start) != -1 and not whole:
+            break
+    title = re.search(r'<title>(.*?)</title>', body.decode(resp.charset, errors='replace'), re.DOTALL)
+    return title.group(1).strip() if title else ''
+
+def http_get(url, cache=None, max_redirects=httpclient.MAX_REDIRECTS):
+    try:
+        # Read only as much of the page as it takes to see the whole title
+        # (a page going into the cache is read whole, a partial body is never stored)
+        resp = (cache.request(url, max_redirects=max_redirects) if cache
+                else httpclient.fetch("GET", url, max_redirects=max_redirects))
+        with resp:
+            title = read_title(resp, whole=bool(cache))
+        print(f"Title: {title}" if title else "No title found")
+        return title
+    except Exception as e:
+        print(f"Error: {e}")
+        return None
+
+def http_get_batch(urls, connections=2, depth=httpclient.PIPELINE_DEPTH):
+    """Fetch many pages with pipelined GETs, a few connections per host; print titles as they arrive"""
+    groups = {}
+    for url in urls:
+        groups.setdefault(httpclient.split_url(url)[:3], []).append(url)
+    # Each connection works through its own share of a host's URLs, in order
+    shares = [group[i::connections] for group in groups.values() for i in range(min(connections, len(group)))]
+    pool = httpclient.ConnectionPool(max_per_host=connections)
+    lock = threading.Lock()
+    failures = 0
     
-    with closing(socket.socket()) as s:
+    def run(share):
+        nonlocal failures
+        done = 0
         try:
-            # Setup connection
-            if parsed.scheme == 'https':
-                s = ssl.create_default_context().wrap_socket(s, server_hostname=host)
-            s.connect((host, port))
-            
-            # Send request and get response
-            s.sendall(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n"
-                      f"User-Agent: Custom-HTTP-Client\r\nConnection: close\r\n\r\n".encode())
-            resp = b''.join(iter(lambda: s.recv(8192), b'')).decode('utf-8', errors='replace')
-            
-            # Extract title
-            title = re.search(r'<title>(.*?)</title>', resp, re.DOTALL)
-            print(f"Title: {title.group(1).strip()}" if title else "No title found")
+            for url, resp in httpclient.pipeline(share, pool=pool, depth=depth):
+                if resp.status == 200:
+                    title = read_title(resp)
+                    result = f"Title: {title}" if title else "No title found"
+                else:
+                    result = f"HTTP {resp.status}"
+                with lock:
+                    print(f"{url}\t{result}", flush=True)
+                done += 1
         except Exception as e:
-            print(f"Error: {e}")
+            with lock:
+                failures += len(share) - done
+                for url in share[done:]:
+                    print(f"{url}\tError: {e}", flush=True)
+    
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max(len(shares), 1)) as executor:
+            list(executor.map(run, shares))
+    finally:
+        pool.close()
+    return failures
 
-if __name__ == "__main__":
+def main(argv=None):
     parser = argparse.ArgumentParser(description="HTTP GET client")
-    parser.add_argument('--url', required=True, help='URL to fetch')
-    http_get(parser.parse_args().url)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--url', help='URL to fetch')
+    source.add_argument('--batch', metavar='FILE', help='Fetch the URLs listed in FILE ("-" for stdin) with pipelining')
+    parser.add_argument('--connections', type=int, default=2, help='Pipelined connections per host in batch mode')
+    parser.add_argument('--depth', type=int, default=httpclient.PIPELINE_DEPTH,
+                        help=f'Requests in flight per connection in batch mode (default: {httpclient.PIPELINE_DEPTH})')
+    parser.add_argument('--max-redirects', type=int, default=httpclient.MAX_REDIRECTS,
+                        help=f'Redirects to follow, 0 to stop at the first (default: {httpclient.MAX_REDIRECTS})')
+    parser.add_argument('--cache', action='store_true', help='Keep a local copy and revalidate it on later runs')
+    parser.add_argument('--cache-dir', help='HTTP cache directory (default: $HTTP_CACHE_DIR or ~/.cache/http_client)')
+    parser.add_argument('--trace', nargs='?', const='-', metavar='FILE',
+                        help='Print a timing waterfall of every request on stderr, or append JSON lines to FILE')
+    args = parser.parse_args(argv)
+    if args.trace:
+        httpclient.trace_to(args.trace)
+    
+    if args.batch:
+        with (sys.stdin if args.batch == '-' else open(args.batch)) as f:
+            urls = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        start = time.perf_counter()
+        failures = http_get_batch(urls, args.connections, args.depth)
+        elapsed = time.perf_counter() - start
+        print(f"{len(urls)} pages, {failures} failed, {elapsed:.2f}s, {len(urls) / elapsed:.1f} pages/s",
+              file=sys.stderr)
+    else:
+        cache = None
+        if args.cache:
+            import httpcache
+            cache = httpcache.HttpCache(args.cache_dir or httpcache.CACHE_DIR)
+        http_get(args.url, cache, args.max_redirects)
+
+if __name__ == "__main__":
+    main()
@@ -1,46 +1,21 @@
 #!/usr/bin/env python3
 
-import socket, ssl, json, re, argparse
-from urllib.parse import urlparse, urlencode
-from contextlib import closing
+import sys, json, re, argparse
+from urllib.parse import urljoin, urlencode
+import httpclient
 
-def request(host, method, path, headers, body=None, port=80, secure=False):
-    """Send HTTP request and return response"""
-    with closing(socket.socket()) as s:
-        if secure:
-            s = ssl.create_default_context().wrap_socket(s, server_hostname=host)
-        s.connect((host, port))
-        
-        req = f"{method} {path} HTTP/1.1\r\n" + "\r\n".join(f"{k}: {v}" for k, v in headers.items()) + "\r\n\r\n"
-        s.sendall(req.encode())
-        if body:
-            s.sendall(body.encode() if isinstance(body, str) else body)
-        
-        return b''.join(iter(lambda: s.recv(8192), b'')).decode('utf-8', errors='replace')
-
-def extract_cookies(response):
-    """Extract cookies from response headers"""
-    cookies = {}
-    for line in response.split('\r\n'):
-        if line.startswith('Set-Cookie:'):
-            parts = line[11:].split(';')[0].strip().split('=', 1)
-            if len(parts) == 2:
-                cookies[parts[0]] = parts[1]
-    return cookies
-
-def http_post(url, data=None, content_type=None, headers=None, json_data=None, follow_redirects=True):
-    """General purpose HTTP POST function"""
-    parsed = urlparse(url)
-    host, path = parsed.hostname, parsed.path or '/'
-    port = parsed.port or (443 if parsed.scheme == 'https' else 80)
-    secure = parsed.scheme == 'https'
-    
-    # Setup headers
+def http_post(url, data=None, content_type=None, headers=None, json_data=None, follow_redirects=True,
+              session=None, stream=False, max_redirects=httpclient.MAX_REDIRECTS):
+    """General purpose HTTP POST function, return (final Response or None, status, cookies)"""
+    # data may also be an open file, a pipe or an iterable of bytes: streams are sent chunked
+    # The body is read and kept on the Response (.content, .text, .json()); with stream=True it is left
+    # on the connection for .iter_body() / .iter_json(), and the caller must close the Response
+    # Redirects are followed up to max_redirects hops (303, and 301/302, turn the POST into a GET);
+    # session, an httpclient.SessionCookies, collects the cookies of every hop and sends them on
+    # Setup headers (Host is filled in by httpclient)
     req_headers = {
-        "Host": host,
-        "User-Agent": "Custom-HTTP-Client",
-        "Accept": "text/html,application/json",
-        "Connection": "close"
+        "User-Agent": httpclient.USER_AGENT,
+        "Accept": "text/html,application/json"
     }
     if headers:
         req_headers.update(headers)
@@ -60,55 +35,46 @@ def http_post(url, data=None, content_type=None, headers=None, json_data=None, f
     
     if content_type:
         req_headers["Content-Type"] = content_type
-    if body:
-        req_headers["Content-Length"] = str(len(body) if isinstance(body, str) else len(body))
     
+    session = httpclient.SessionCookies() if session is None else session
     try:
-        # Send request
-        response = request(host, "POST", path, req_headers, body, port, secure)
-        
-        # Process response
-        status = int(response.split('\r\n')[0].split(' ')[1]) if ' ' in response.split('\r\n')[0] else 0
-        cookies = extract_cookies(response)
+        # Send request over a pooled keep-alive connection; same-origin redirects reuse it
+        resp = httpclient.fetch("POST", url, req_headers, body, max_redirects=max_redirects if follow_redirects else 0,
+                                cookies=session)
+        for status, _, target in resp.history:
+            print(f"Following redirect ({status}) to: {target}")
         
-        # Handle redirects if needed
-        if follow_redirects and 300 <= status < 400:
-            location = re.search(r'Location:\s*(.+?)(?:\r\n)', response)
-            if location:
-                loc = location.group(1).strip()
-                loc = f"{parsed.scheme}://{host}{loc}" if loc.startswith('/') else loc
-                print(f"Following redirect to: {loc}")
-                
-                # Perform redirect
-                redirect = urlparse(loc)
-                redir_headers = {"Host": redirect.hostname, "User-Agent": "Custom-HTTP-Client"}
-                if cookies:
-                    redir_headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in cookies.items())
-                
-                redir_resp = request(
-                    redirect.hostname, "GET", redirect.path or '/', redir_headers,
-                    port=redirect.port or (443 if redirect.scheme == 'https' else 80), 
-                    secure=redirect.scheme == 'https'
-                )
-                cookies.update(extract_cookies(redir_resp))
-                return redir_resp, 200, cookies
-        
-        return response, status, cookies
+        if not stream:
+            resp.read()
+        return resp, resp.status, session.values()
     except Exception as e:
         print(f"Error: {e}")
         return None, 0, {}
 
-def wordpress_login(url, username, password):
+def wordpress_login(url, username, password, jar=None):
     """WordPress login handler"""
-    parsed = urlparse(url)
-    host = parsed.hostname
-    port = parsed.port or (443 if parsed.scheme == 'https' else 80)
-    secure = parsed.scheme == 'https'
+    site = urljoin(url, "/")
+    
+    # Reuse a stored session made with these credentials if the server still takes it: one GET instead of two
+    # requests, and a session it has dropped sends /wp-admin/ back to the login page
+    if jar:
+        cookies = jar.for_path(jar.load(site, username, password), "/wp-admin/")
+        if any(name.startswith('wordpress_logged_in') for name in cookies):
+            admin_url = f"{url.rstrip('/')}/wp-admin/"
+            cookie = "; ".join(f"{k}={v}" for k, v in cookies.items())
+            with httpclient.request("GET", admin_url, {"Cookie": cookie}) as resp:
+                resp.read()
+            if resp.status == 200:
+                print(f"User {username} đăng nhập thành công (cached session)")
+                return resp, resp.status, cookies
+            jar.forget(site, username)
     
-    # Get initial cookies
-    headers = {"Host": host, "User-Agent": "Custom-HTTP-Client", "Connection": "close"}
-    resp = request(host, "GET", "/wp-login.php", headers, port=port, secure=secure)
-    initial_cookies = extract_cookies(resp)
+    # Get initial cookies; the session carries them through the login and its redirect to /wp-admin/
+    login_url = f"{url.rstrip('/')}/wp-login.php"
+    session = httpclient.SessionCookies()
+    with httpclient.request("GET", login_url) as resp:
+        resp.read()
+        session.update(login_url, resp.headers)
     
     # Login
     login_data = {
@@ -116,17 +82,18 @@ def wordpress_login(url, username, password):
         'redirect_to': f"{url.rstrip('/')}/wp-admin/", 'testcookie': '1'
     }
     
-    custom_headers = {"Cookie": "; ".join(f"{k}={v}" for k, v in initial_cookies.items())} if initial_cookies else None
-    resp, status, cookies = http_post(
-        f"{url.rstrip('/')}/wp-login.php", data=login_data, headers=custom_headers
-    )
+    resp, status, cookies = http_post(login_url, data=login_data, session=session)
     
-    success = ('Location:' in resp and '/wp-admin/' in resp) or 'wordpress_logged_in' in str(cookies)
+    landed = httpclient.split_url(resp.url)[3] if resp else ''
+    success = landed.startswith('/wp-admin/') or any(name.startswith('wordpress_logged_in') for name in cookies)
     print(f"User {username} đăng nhập {'thành công' if success else 'thất bại'}")
+    if success and jar:
+        jar.forget(site, username)
+        jar.update(site, username, session.received, password)
     
     return resp, status, cookies
 
-if __name__ == "__main__":
+def main(argv=None):
     parser = argparse.ArgumentParser(description="HTTP POST client")
     parser.add_argument('--url', required=True, help='URL to send POST request to')
     parser.add_argument('--user', help='Username (for WordPress login)')
@@ -134,12 +101,24 @@ if __name__ == "__main__":
     parser.add_argument('--content-type', help='Content-Type header value')
     parser.add_argument('--form-param', nargs='*', help='Form parameters (key=value)')
     parser.add_argument('--json', help='JSON data to send (as string)')
+    parser.add_argument('--data-file', help='Send the contents of a file as the body ("-" streams stdin chunked)')
+    parser.add_argument('--json-lines', action='store_true',
+                        help='Print each element of a JSON array response on its own line as it arrives')
     parser.add_argument('--header', nargs='*', help='Custom headers (key=value)')
-    args = parser.parse_args()
+    parser.add_argument('--max-redirects', type=int, default=httpclient.MAX_REDIRECTS,
+                        help=f'Redirects to follow, 0 to stop at the first (default: {httpclient.MAX_REDIRECTS})')
+    parser.add_argument('--cookie-jar', default=httpclient.COOKIE_JAR, help='Session cookie cache file')
+    parser.add_argument('--no-cookie-jar', action='store_true', help='Always log in, do not cache the session')
+    parser.add_argument('--trace', nargs='?', const='-', metavar='FILE',
+                        help='Print a timing waterfall of every request on stderr, or append JSON lines to FILE')
+    args = parser.parse_args(argv)
+    if args.trace:
+        httpclient.trace_to(args.trace)
     
     if args.user and args.password:
         # WordPress login
-        wordpress_login(args.url, args.user, args.password)
+        wordpress_login(args.url, args.user, args.password,
+                        None if args.no_cookie_jar else httpclient.CookieJar(args.cookie_jar))
     else:
         # General POST request
         form_data = {}
@@ -157,25 +136,36 @@ if __name__ == "__main__":
                     custom_headers[k] = v
         
         json_data = json.loads(args.json) if args.json else None
+        data, content_type = form_data or None, args.content_type
+        if args.data_file:
+            # Streamed from disk or the pipe, never read into memory
+            data = sys.stdin.buffer if args.data_file == '-' else open(args.data_file, 'rb')
+            content_type = content_type or 'application/octet-stream'
         
         resp, status, cookies = http_post(
-            args.url, data=form_data or None, content_type=args.content_type,
-            headers=custom_headers or None, json_data=json_data
+            args.url, data=data, content_type=content_type,
+            headers=custom_headers or None, json_data=json_data, stream=args.json_lines,
+            max_redirects=args.max_redirects
         )
         
         print(f"Status Code: {status}")
         
-        if resp:
-            # Try to extract useful information
-            title = re.search(r'<title>(.*?)</title>', resp, re.DOTALL)
+        if resp and args.json_lines:
+            # Elements are decoded while the body streams in, never all held at once
+            with resp:
+                for item in resp.iter_json():
+                    print(json.dumps(item))
+        elif resp:
+            # Try to extract useful information; the body is decoded once, with its declared charset
+            title = re.search(r'<title>(.*?)</title>', resp.text, re.DOTALL)
             if title:
                 print(f"Response Title: {title.group(1).strip()}")
             
             try:
-                body = resp.split('\r\n\r\n', 1)[1] if '\r\n\r\n' in resp else resp
-                json_resp = json.loads(body)
-                print(f"JSON Response:\n{json.dumps(json_resp, indent=2)}")
-            except (json.JSONDecodeError, IndexError):
-                body = resp.split('\r\n\r\n', 1)[1] if '\r\n\r\n' in resp else ''
-                if body:
-                    print(f"Response Body (first 500 chars):\n{body[:500]}{'...' if len(body) > 500 else ''}")
+                print(f"JSON Response:\n{json.dumps(resp.json(), indent=2)}")
+            except ValueError:
+                if resp.text:
+                    print(f"Response Body (first 500 chars):\n{resp.text[:500]}{'...' if len(resp.text) > 500 else ''}")
+
+if __name__ == "__main__":
+    main()
@@ -1,156 +1,387 @@
 #!/usr/bin/env python3
 
-import socket, ssl, re, os, time, mimetypes, argparse
-from urllib.parse import urlparse, urlencode
-from contextlib import closing
+import re, os, sys, glob, json, mmap, stat, time, argparse, threading
+from urllib.parse import urljoin, urlencode
+import httpclient
 
-def send_request(host, method, path, headers, body=None, port=80, secure=False):
-    """Send HTTP request and return response"""
-    with closing(socket.socket()) as s:
-        if secure:
-            s = ssl.create_default_context().wrap_socket(s, server_hostname=host)
-        s.connect((host, port))
-        
-        # Send headers
-        req = f"{method} {path} HTTP/1.1\r\n"
-        for k, v in headers.items():
-            req += f"{k}: {v}\r\n"
-        req += "\r\n"
-        s.sendall(req.encode())
-        
-        # Send body if present
-        if body:
-            s.sendall(body if isinstance(body, bytes) else body.encode())
-        
-        # Get response
-        return b''.join(iter(lambda: s.recv(8192), b''))
+UPLOAD_INDEX = os.path.expanduser(os.environ.get('WP_UPLOAD_INDEX', '~/.wp_upload_index.json'))
+HASH_BLOCK = 8 << 20  # hashlib releases the GIL on large updates, so threads hash in parallel
 
-def extract_cookies(response):
-    """Extract cookies from HTTP response"""
-    cookies = {}
-    text = response.decode('utf-8', errors='replace')
-    for line in text.split('\r\n'):
-        if line.startswith('Set-Cookie:'):
-            parts = line[11:].strip().split(';')[0].strip().split('=', 1)
-            if len(parts) == 2:
-                cookies[parts[0]] = parts[1]
-    return cookies
+def file_digest(path):
+    """SHA-256 of a file, fed to the hash from a memory map one block at a time"""
+    import hashlib
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                for start in range(0, size, HASH_BLOCK):
+                    digest.update(view[start:start + HASH_BLOCK])
+                view.release()
+    return digest.hexdigest()
 
-def login(url, username, password):
+class UploadIndex:
+    """What was already uploaded to which site, keyed by the SHA-256 of the file contents"""
+    
+    def __init__(self, path=UPLOAD_INDEX):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = {}
+        self.data.setdefault('hashes', {})   # absolute path -> size, mtime and digest, to skip rehashing
+        self.data.setdefault('uploads', {})  # site -> digest -> url, file name and time
+    
+    def save(self):
+        with self.lock:
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(self.data, f)
+            os.replace(tmp, self.path)
+    
+    def digest(self, path):
+        """Digest of a file, reused from the index while its size and mtime are unchanged"""
+        st = os.stat(path)
+        key = os.path.abspath(path)
+        known = self.data['hashes'].get(key)
+        if known and known['size'] == st.st_size and known['mtime'] == st.st_mtime_ns:
+            return known['sha256']
+        digest = file_digest(path)
+        with self.lock:
+            self.data['hashes'][key] = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'sha256': digest}
+        return digest
+    
+    def digests(self, paths, workers=None):
+        """Digests of many files, hashed in parallel; unreadable files are left out"""
+        def one(path):
+            try:
+                return path, self.digest(path)
+            except OSError:
+                return path, None
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(workers or os.cpu_count()) as executor:
+            return {path: digest for path, digest in executor.map(one, paths) if digest}
+    
+    def lookup(self, site, digest):
+        """URL of an earlier upload of the same contents to this site, or None"""
+        entry = self.data['uploads'].get(site, {}).get(digest)
+        return entry['url'] if entry else None
+    
+    def record(self, site, digest, url, path):
+        with self.lock:
+            self.data['uploads'].setdefault(site, {})[digest] = {
+                'url': url, 'file': os.path.basename(path), 'time': int(time.time())}
+
+def skipped_result(local_file, url):
+    return {'file': local_file, 'success': True, 'url': url, 'error': None, 'bytes': 0, 'seconds': 0.0,
+            'skipped': True}
+
+def login(url, username, password, jar=None, fresh=False):
     """Login to WordPress and get session cookies"""
-    parsed = urlparse(url)
-    host, port = parsed.hostname, parsed.port or (443 if parsed.scheme == 'https' else 80)
-    secure = parsed.scheme == 'https'
+    site = urljoin(url, "/")
+    login_url = urljoin(url, "/wp-login.php")
+    
+    # Reuse a stored session made with these credentials if the server still takes it. Checked up front: a
+    # large upload on a dropped session fails with a broken pipe before the redirect to the login page is read
+    if jar and not fresh:
+        cookies = jar.for_path(jar.load(site, username, password), "/wp-admin/")
+        if any(name.startswith('wordpress_logged_in') for name in cookies):
+            cookie = "; ".join(f"{k}={v}" for k, v in cookies.items())
+            with httpclient.request("GET", urljoin(url, "/wp-admin/"), {"Cookie": cookie}) as resp:
+                resp.read()
+            if resp.status == 200:
+                return cookies
+            jar.forget(site, username)
     
-    # Get login page cookies
-    headers = {"Host": host, "User-Agent": "Custom-HTTP-Client", "Connection": "close"}
-    resp = send_request(host, "GET", "/wp-login.php", headers, port=port, secure=secure)
-    cookies = extract_cookies(resp)
+    # Get login page cookies (the connection stays open for the login POST)
+    with httpclient.request("GET", login_url) as resp:
+        resp.read()
+        cookies = resp.cookies
+        set_cookies = resp.headers.get_all('set-cookie')
     
     # Send login request
     login_data = urlencode({
         'log': username, 'pwd': password, 'wp-submit': 'Log In',
-        'redirect_to': f"{parsed.scheme}://{host}/wp-admin/", 'testcookie': '1'
+        'redirect_to': urljoin(url, "/wp-admin/"), 'testcookie': '1'
     })
     
-    headers = {
-        "Host": host, "User-Agent": "Custom-HTTP-Client",
-        "Content-Type": "application/x-www-form-urlencoded",
-        "Content-Length": str(len(login_data)),
-        "Connection": "close"
-    }
+    headers = {"Content-Type": "application/x-www-form-urlencoded"}
     if cookies:
         headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in cookies.items())
     
-    resp = send_request(host, "POST", "/wp-login.php", headers, login_data, port, secure)
-    login_cookies = extract_cookies(resp)
-    cookies.update(login_cookies)
+    with httpclient.request("POST", login_url, headers, login_data) as resp:
+        resp.read()
+        cookies.update(resp.cookies)
+        set_cookies += resp.headers.get_all('set-cookie')
+        location = resp.headers.get('location', '')
     
     # Check login success
-    text = resp.decode('utf-8', errors='replace')
-    if 'wordpress_logged_in' in str(cookies) or ('Location:' in text and '/wp-admin/' in text):
+    if 'wordpress_logged_in' in str(cookies) or '/wp-admin/' in location:
+        if jar:
+            jar.forget(site, username)
+            jar.update(site, username, set_cookies, password)
         return cookies
     return None
 
-def http_upload_file(url, username, password, local_file):
-    """Upload a file to WordPress"""
-    if not os.path.exists(local_file):
-        print(f"File {local_file} does not exist")
-        return
+def is_stream(local_file):
+    """'-' (stdin), a pipe or a FIFO: read once, length unknown until the end"""
+    return local_file == '-' or not stat.S_ISREG(os.stat(local_file).st_mode)
+
+class CountingReader:
+    """A stream's reads, counting the bytes that went by"""
     
-    # Login
-    cookies = login(url, username, password)
-    if not cookies:
-        print("Login failed")
-        return
+    def __init__(self, f):
+        self.f, self.size = f, 0
     
-    # Prepare upload
-    parsed = urlparse(url)
-    host, port = parsed.hostname, parsed.port or (443 if parsed.scheme == 'https' else 80)
-    secure = parsed.scheme == 'https'
+    def read1(self, size=-1):
+        block = httpclient.read_block(self.f, size)
+        self.size += len(block)
+        return block
+    
+    read = read1
+
+def upload_file(url, cookies, local_file, pool=None, filename=None):
+    """Upload one file with an existing session, return a result dict"""
+    # local_file may be '-' for stdin or a pipe; such streams are sent with chunked encoding
+    filename = filename or ('stdin' if local_file == '-' else os.path.basename(local_file))
+    result = {'file': local_file, 'success': False, 'url': None, 'error': None, 'bytes': 0, 'seconds': 0.0}
+    start = time.monotonic()
     
     try:
         # Create multipart form data
         boundary = f"---------------------------{int(time.time())}"
-        filename = os.path.basename(local_file)
-        content_type = mimetypes.guess_type(local_file)[0] or 'application/octet-stream'
-        
-        with open(local_file, 'rb') as f:
-            file_content = f.read()
+        import mimetypes
+        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
         
-        # Build the form data
-        body = []
-        body.append(f"--{boundary}\r\n".encode())
-        body.append(f'Content-Disposition: form-data; name="_wpnonce"\r\n\r\n'.encode())
-        body.append(f"wp_mock_nonce\r\n".encode())
-        body.append(f"--{boundary}\r\n".encode())
-        body.append(f'Content-Disposition: form-data; name="action"\r\n\r\n'.encode())
-        body.append(f"upload-attachment\r\n".encode())
-        body.append(f"--{boundary}\r\n".encode())
-        body.append(f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'.encode())
-        body.append(f'Content-Type: {content_type}\r\n\r\n'.encode())
-        body.append(file_content)
-        body.append(f"\r\n--{boundary}--\r\n".encode())
+        # Build the form data around the file; the file itself is streamed from disk
+        head = []
+        head.append(f"--{boundary}\r\n".encode())
+        head.append(f'Content-Disposition: form-data; name="_wpnonce"\r\n\r\n'.encode())
+        head.append(f"wp_mock_nonce\r\n".encode())
+        head.append(f"--{boundary}\r\n".encode())
+        head.append(f'Content-Disposition: form-data; name="action"\r\n\r\n'.encode())
+        head.append(f"upload-attachment\r\n".encode())
+        head.append(f"--{boundary}\r\n".encode())
+        head.append(f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'.encode())
+        head.append(f'Content-Type: {content_type}\r\n\r\n'.encode())
+        head = b''.join(head)
+        tail = f"\r\n--{boundary}--\r\n".encode()
         
-        data = b''.join(body)
-        
-        # Send upload request
+        # Send upload request (Content-Length, or chunked for a stream, is set by httpclient)
         headers = {
-            "Host": host,
-            "User-Agent": "Custom-HTTP-Client",
             "Cookie": "; ".join(f"{k}={v}" for k, v in cookies.items()),
-            "Content-Type": f"multipart/form-data; boundary={boundary}",
-            "Content-Length": str(len(data)),
-            "Connection": "close"
+            "Content-Type": f"multipart/form-data; boundary={boundary}"
         }
         
-        resp = send_request(host, "POST", "/wp-admin/async-upload.php", headers, data, port, secure)
-        text = resp.decode('utf-8', errors='replace')
+        # Reuses the connection kept alive by login()
+        stream = is_stream(local_file)
+        with (open(sys.stdin.fileno(), 'rb', closefd=False) if local_file == '-' else open(local_file, 'rb')) as f:
+            body = [head, CountingReader(f) if stream else f, tail]
+            with httpclient.request("POST", urljoin(url, "/wp-admin/async-upload.php"), headers, body, pool) as resp:
+                status, text = resp.status, resp.text
+                location = resp.headers.get('location', '')
+            size = body[1].size if stream else os.fstat(f.fileno()).st_size
         
         # Process response
-        if '200 OK' in text and ('success' in text.lower() or 'file' in text.lower()):
+        if status in (301, 302, 303) and 'wp-login.php' in location:
+            result['error'], result['stale'] = "Session expired (redirected to login)", True
+        elif status == 200 and ('success' in text.lower() or 'file' in text.lower()):
             url_match = re.search(r'"url"\s*:\s*"([^"]+)"', text)
             if url_match:
-                print(f"Upload success. URL: {url_match.group(1)}")
+                result['url'] = url_match.group(1)
             else:
                 upload_path = f"/wp-content/uploads/{time.strftime('%Y/%m/')}{filename}"
-                print(f"Upload success. URL: {parsed.scheme}://{host}{upload_path}")
+                result['url'] = urljoin(url, upload_path)
+            result['success'], result['bytes'] = True, size
         else:
-            print("Upload failed.")
-            if 'error' in text.lower():
-                error = re.search(r'"error"\s*:\s*"([^"]+)"', text)
-                if error:
-                    print(f"Error: {error.group(1)}")
+            error = re.search(r'"error"\s*:\s*"([^"]+)"', text)
+            result['error'] = error.group(1) if error else f"HTTP {status}"
     
     except Exception as e:
-        print(f"Error: {e}")
+        result['error'] = str(e)
+    
+    result['seconds'] = round(time.monotonic() - start, 3)
+    return result
 
-if __name__ == "__main__":
+def http_upload_file(url, username, password, local_file, jar=None, index=None, filename=None):
+    """Upload a file to WordPress, return the result dict (None if it never got to the upload)"""
+    if local_file != '-' and not os.path.exists(local_file):
+        print(f"File {local_file} does not exist")
+        return
+    
+    # The same contents were uploaded to this site before: nothing to send
+    site = urljoin(url, "/")
+    stream = is_stream(local_file)
+    digest = index.digest(local_file) if index and not stream else None
+    if digest and index.lookup(site, digest):
+        print(f"Already uploaded. URL: {index.lookup(site, digest)}")
+        index.save()
+        return skipped_result(local_file, index.lookup(site, digest))
+    
+    # Login
+    cookies = login(url, username, password, jar)
+    if not cookies:
+        print("Login failed")
+        return
+    
+    result = upload_file(url, cookies, local_file, filename=filename)
+    if result.get('stale') and not stream:
+        # The stored session is no longer valid: authenticate again, once (a stream cannot be read twice)
+        cookies = login(url, username, password, jar, fresh=True)
+        if cookies:
+            result = upload_file(url, cookies, local_file, filename=filename)
+    if result['success']:
+        print(f"Upload success. URL: {result['url']}")
+        if digest:  # A stream has none: nothing to recognise it by next time
+            index.record(site, digest, result['url'], local_file)
+            index.save()
+    else:
+        print("Upload failed.")
+        print(f"Error: {result['error']}")
+    return result
+
+def collect_files(sources, manifest=None):
+    """Expand directories, globs and manifest entries into a list of files"""
+    if manifest:
+        with (sys.stdin if manifest == '-' else open(manifest)) as f:
+            sources = list(sources) + [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    
+    files, seen = [], set()
+    for source in sources:
+        if os.path.isdir(source):
+            matches = sorted(os.path.join(root, name) for root, _, names in os.walk(source) for name in names)
+        else:
+            matches = sorted(glob.glob(source, recursive=True)) or [source]
+        for path in matches:
+            if path not in seen:
+                seen.add(path)
+                files.append(path)
+    return files
+
+def bulk_upload(url, username, password, files, workers=4, jar=None, index=None, hash_workers=None, retries=4):
+    """Log in once, then upload files concurrently over persistent connections"""
+    results, start = {}, time.monotonic()
+    site, digests, copies = urljoin(url, "/"), {}, {}
+    if index:
+        # Hash everything up front (in parallel) and drop what this site already has
+        digests = index.digests(files, hash_workers)
+        for path in files:
+            uploaded = path in digests and index.lookup(site, digests[path])
+            if uploaded:
+                results[path] = skipped_result(path, uploaded)
+        files = [path for path in files if path not in results]
+        # Files with the same contents as an earlier one in this run wait for its upload instead of repeating it
+        first = {}
+        for path in files:
+            if path in digests:
+                first.setdefault(digests[path], path)
+                if first[digests[path]] != path:
+                    copies[path] = first[digests[path]]
+        files = [path for path in files if path not in copies]
+        print(f"{len(results)} already uploaded, {len(copies)} duplicates, {len(files)} to upload", file=sys.stderr)
+    
+    cookies = login(url, username, password, jar) if files else {}
+    if files and not cookies:
+        print("Login failed")
+        return None
+    
+    # Start gently and let the controller find how many uploads the site takes. A 429 is sent again: the
+    # server refused the upload before storing it, which a 503 does not promise
+    controller = httpclient.AdaptiveController(initial=min(2, workers), maximum=workers, retries=retries,
+                                               unsafe_retries=(429,))
+    pool = httpclient.ConnectionPool(max_per_host=workers, controller=controller)
+    
+    def run(paths):
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        with ThreadPoolExecutor(workers) as executor:
+            futures = [executor.submit(upload_file, url, cookies, path, pool) for path in paths]
+            for n, future in enumerate(as_completed(futures), 1):
+                result = future.result()
+                results[result['file']] = result
+                if result['success'] and result['file'] in digests:
+                    index.record(site, digests[result['file']], result['url'], result['file'])
+                if result['success']:
+                    print(f"[{n}/{len(paths)}] {result['file']} -> {result['url']}", file=sys.stderr)
+                else:
+                    print(f"[{n}/{len(paths)}] {result['file']} FAILED: {result['error']}", file=sys.stderr)
+    
+    try:
+        run(files)
+        # The stored session is no longer valid: authenticate again, once
+        stale = [r['file'] for r in results.values() if r.get('stale')]
+        if stale:
+            cookies = login(url, username, password, jar, fresh=True)
+            if cookies:
+                run(stale)
+        for path, original in copies.items():
+            if results[original]['success']:
+                results[path] = skipped_result(path, results[original]['url'])
+            else:
+                results[path] = {'file': path, 'success': False, 'url': None, 'bytes': 0, 'seconds': 0.0,
+                                 'error': f"Same contents as {original}, which failed"}
+    finally:
+        pool.close()
+        if index:
+            index.save()
+    
+    results = list(results.values())
+    elapsed = time.monotonic() - start
+    total = sum(r['bytes'] for r in results)
+    return {
+        'files': len(results),
+        'succeeded': sum(r['success'] for r in results),
+        'failed': sum(not r['success'] for r in results),
+        'skipped': sum(bool(r.get('skipped')) for r in results),
+        'bytes': total,
+        'seconds': round(elapsed, 3),
+        'files_per_second': round(len(results) / elapsed, 2) if elapsed else None,
+        'mb_per_second': round(total / elapsed / 1e6, 2) if elapsed else None,
+        'sites': controller.snapshot(),
+        'failures': [r for r in results if not r['success']],
+        'results': results
+    }
+
+def main(argv=None):
     parser = argparse.ArgumentParser(description="HTTP file upload client")
     parser.add_argument('--url', required=True, help='WordPress URL')
     parser.add_argument('--user', required=True, help='WordPress username')
     parser.add_argument('--password', required=True, help='WordPress password')
-    parser.add_argument('--local-file', required=True, help='Path to local file to upload')
-    args = parser.parse_args()
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--local-file', help='Path to local file to upload ("-" or a pipe is streamed chunked)')
+    source.add_argument('--bulk', nargs='+', help='Directories or glob patterns to upload')
+    source.add_argument('--manifest', help='File listing paths or globs to upload, one per line ("-" for stdin)')
+    parser.add_argument('--name', help='File name to give the upload (default: the local file name)')
+    parser.add_argument('--workers', type=int, default=4, help='Concurrent uploads in bulk mode (default: 4)')
+    parser.add_argument('--summary', help='Write the bulk JSON summary to this file instead of stdout')
+    parser.add_argument('--cookie-jar', default=httpclient.COOKIE_JAR, help='Session cookie cache file')
+    parser.add_argument('--no-cookie-jar', action='store_true', help='Always log in, do not cache the session')
+    parser.add_argument('--index', default=UPLOAD_INDEX, help='Index of uploaded file hashes used to skip duplicates')
+    parser.add_argument('--no-index', action='store_true', help='Upload every file, even if it was uploaded before')
+    parser.add_argument('--hash-workers', type=int, help='Threads hashing files in bulk mode (default: CPU count)')
+    parser.add_argument('--retries', type=int, default=4,
+                        help='Attempts after a 429/503 or a failed connection in bulk mode (default: 4)')
+    parser.add_argument('--trace', nargs='?', const='-', metavar='FILE',
+                        help='Print a timing waterfall of every request on stderr, or append JSON lines to FILE')
+    args = parser.parse_args(argv)
+    if args.trace:
+        httpclient.trace_to(args.trace)
+    jar = None if args.no_cookie_jar else httpclient.CookieJar(args.cookie_jar)
+    index = None if args.no_index else UploadIndex(args.index)
     
-    http_upload_file(args.url, args.user, args.password, args.local_file)
+    if args.local_file:
+        http_upload_file(args.url, args.user, args.password, args.local_file, jar, index, args.name)
+    else:
+        summary = bulk_upload(args.url, args.user, args.password, collect_files(args.bulk or [], args.manifest),
+                              args.workers, jar, index, args.hash_workers, args.retries)
+        if summary:
+            if args.summary:
+                with open(args.summary, 'w') as f:
+                    json.dump(summary, f, indent=2)
+            else:
+                print(json.dumps(summary, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,12 @@
+#!/bin/bash
+
+# Self-signed certificate for running the test server over HTTPS (localhost / 127.0.0.1)
+cd "$(dirname "$0")"
+
+openssl req -x509 -newkey rsa:2048 -nodes -days 365 \
+    -keyout key.pem -out cert.pem -subj "/CN=localhost" \
+    -addext "subjectAltName=DNS:localhost,IP:127.0.0.1"
+
+echo "Created cert.pem and key.pem"
+echo "Start the server with: ./start_server.sh --port 8443 --cert cert.pem --key key.pem"
+echo "Trust it in the clients with: export SSL_CERT_FILE=$(pwd)/cert.pem"
@@ -1,21 +1,65 @@
 #!/usr/bin/env python3
 
-from flask import Flask, request, render_template_string, redirect, url_for, send_from_directory, jsonify
+from flask import Flask, Request, request, render_template_string, redirect, url_for, send_from_directory, jsonify, g
+from werkzeug.serving import WSGIRequestHandler
 import os
 import time
+import socket
 import hashlib
 import shutil
+import zlib
+import logging
+import argparse
+import tempfile
+import threading
+import math
+
+class UploadRequest(Request):
+    """In --perf mode uploaded files are written straight into the uploads directory while the form is parsed"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if not app.config['PERF'] or not filename:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        upload_dir = os.path.join(app.config['UPLOAD_DIR'], time.strftime('%Y/%m/'))
+        os.makedirs(upload_dir, exist_ok=True)
+        stream = tempfile.NamedTemporaryFile('wb+', dir=upload_dir, prefix='.upload-', delete=False)
+        g.setdefault('upload_streams', []).append(stream.name)  # Removed at teardown unless saved
+        return stream
+
+class KeepAliveHandler(WSGIRequestHandler):
+    """HTTP/1.1 with persistent connections; Nagle off so headers and body are not held back"""
+    protocol_version = 'HTTP/1.1'
+    
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
 app = Flask(__name__)
+app.request_class = UploadRequest
+app.config['PERF'] = False
 
-# Create directories for uploads
-os.makedirs('uploads/wp-content/uploads', exist_ok=True)
+# Create directories for uploads (--uploads-dir serves another directory as /wp-content/uploads/)
+app.config['UPLOAD_DIR'] = 'uploads/wp-content/uploads'
+os.makedirs(app.config['UPLOAD_DIR'], exist_ok=True)
+# Streamed uploads are moved into place with the permissions file.save() would give them
+UMASK = os.umask(0)
+os.umask(UMASK)
 
 # Simple authentication
 USERS = {
     'test': 'test123QWE@AD'
 }
 
+# Content types worth gzipping when compression is enabled (--compress)
+COMPRESSIBLE = ('text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml')
+app.config['COMPRESS'] = False
+
+# Throttling (--throttle, --max-concurrent): requests over the rate get 429, over the concurrency 503
+app.config['THROTTLE_RATE'] = 0
+app.config['MAX_CONCURRENT'] = 0
+throttle = {'tokens': 0.0, 'updated': time.monotonic(), 'active': 0}
+throttle_lock = threading.Lock()
+
 # Session storage (simple dict instead of cookies)
 sessions = {}
 
@@ -147,7 +191,10 @@ def media_new():
 def async_upload():
     username = check_auth()
     if not username:
-        return redirect('/wp-login.php')
+        # The upload body was never read, so the connection cannot carry another request
+        response = redirect('/wp-login.php')
+        response.headers['Connection'] = 'close'
+        return response
     
     if 'file' not in request.files:
         return jsonify({'success': False, 'error': 'No file part'})
@@ -158,12 +205,12 @@ def async_upload():
     
     # Create year/month directory structure
     year_month = time.strftime('%Y/%m/')
-    upload_dir = os.path.join('uploads/wp-content/uploads', year_month)
+    upload_dir = os.path.join(app.config['UPLOAD_DIR'], year_month)
     os.makedirs(upload_dir, exist_ok=True)
     
     # Save the file
     file_path = os.path.join(upload_dir, file.filename)
-    file.save(file_path)
+    save_upload(file, file_path)
     
     # Return success response
     upload_url = f"/wp-content/uploads/{year_month}{file.filename}"
@@ -175,12 +222,145 @@ def async_upload():
         }
     })
 
+def save_upload(file, file_path):
+    """Move a file that was streamed to disk into place, or copy one Werkzeug spooled"""
+    stream_path = getattr(file.stream, 'name', None)
+    if isinstance(stream_path, str) and os.path.basename(stream_path).startswith('.upload-'):
+        file.stream.close()
+        os.chmod(stream_path, 0o666 & ~UMASK)
+        os.replace(stream_path, file_path)
+    else:
+        file.save(file_path)
+
+@app.route('/echo', methods=['POST'])
+def echo():
+    # Consume the body a block at a time (chunked bodies arrive dechunked) and describe what came in
+    digest, size = hashlib.sha256(), 0
+    while block := request.stream.read(256 * 1024):
+        digest.update(block)
+        size += len(block)
+    return jsonify({
+        'bytes': size,
+        'sha256': digest.hexdigest(),
+        'content_type': request.content_type,
+        'transfer_encoding': request.headers.get('Transfer-Encoding')
+    })
+
+@app.route('/redirect/<int:status>', methods=['GET', 'HEAD', 'POST', 'PUT'])
+def redirect_to(status):
+    # /redirect/307?to=/echo answers with that status, for trying out how clients follow redirects
+    request.get_data()  # Read the body so the connection can carry the next hop
+    response = redirect(request.args.get('to', '/'), code=status)
+    if 'max_age' in request.args:
+        response.headers['Cache-Control'] = f"max-age={request.args['max_age']}"
+    return response
+
 @app.route('/wp-content/uploads/<path:filepath>')
 def serve_uploads(filepath):
-    return send_from_directory('uploads/wp-content/uploads', filepath)
+    # Range requests are answered with 206; advertise them on full responses too
+    # ETag and Last-Modified let clients revalidate (If-None-Match / If-Modified-Since -> 304)
+    response = send_from_directory(app.config['UPLOAD_DIR'], filepath, conditional=True, etag=True)
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
+
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+@app.before_request
+def limit_requests():
+    rate, limit = app.config['THROTTLE_RATE'], app.config['MAX_CONCURRENT']
+    if not rate and not limit:
+        return None
+    with throttle_lock:
+        # Token bucket holding up to one second of requests
+        now = time.monotonic()
+        throttle['tokens'] = min(rate, throttle['tokens'] + (now - throttle['updated']) * rate)
+        throttle['updated'] = now
+        if rate and throttle['tokens'] < 1:
+            status, retry_after = 429, math.ceil((1 - throttle['tokens']) / rate)
+        elif limit and throttle['active'] >= limit:
+            status, retry_after = 503, 1
+        else:
+            if rate:
+                throttle['tokens'] -= 1
+            throttle['active'] += 1
+            g.throttle_counted = True
+            return None
+    
+    # The body is not wanted, but reading it keeps a keep-alive connection in step
+    while request.stream.read(256 * 1024):
+        pass
+    response = jsonify({'success': False, 'error': 'Too many requests' if status == 429 else 'Server busy'})
+    response.status_code = status
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+@app.teardown_request
+def finish_request(exc):
+    if g.get('throttle_counted'):
+        with throttle_lock:
+            throttle['active'] -= 1
+    # Parts streamed to disk but never saved (another field name, a rejected upload, an aborted request)
+    for path in g.get('upload_streams', ()):
+        if os.path.exists(path):
+            os.remove(path)
+
+@app.after_request
+def compress(response):
+    # Byte ranges and validators stay on the identity encoding
+    if (not app.config['COMPRESS'] or response.status_code != 200 or 'Content-Encoding' in response.headers
+            or not response.mimetype.startswith(COMPRESSIBLE) or request.accept_encodings['gzip'] <= 0):
+        return response
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Content-Encoding'] = 'gzip'
+    response.headers.pop('Accept-Ranges', None)
+    if response.headers.get('ETag', '').startswith('"'):
+        # The gzipped bytes differ from the file the strong validator describes
+        response.headers['ETag'] = 'W/' + response.headers['ETag']
+    if response.direct_passthrough:
+        # Files are compressed while they are sent, the length is not known up front
+        response.response = gzip_stream(response.response)
+        response.direct_passthrough = False
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(b''.join(gzip_stream([response.get_data()])))
+    return response
 
 if __name__ == '__main__':
-    print("Starting mock WordPress server on http://localhost:8000")
+    parser = argparse.ArgumentParser(description="Mock WordPress server")
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on (default: 8000)')
+    parser.add_argument('--compress', action='store_true', help='Gzip text, JSON and HTML responses')
+    parser.add_argument('--cert', help='TLS certificate (PEM) to serve HTTPS, see generate_cert.sh')
+    parser.add_argument('--key', help='Private key (PEM) for --cert')
+    parser.add_argument('--perf', action='store_true',
+                        help='Benchmark mode: threaded, no debug or request log, HTTP/1.1 keep-alive, streamed uploads')
+    parser.add_argument('--throttle', type=float, default=0,
+                        help='Requests per second to accept; the rest get 429 with Retry-After (default: off)')
+    parser.add_argument('--max-concurrent', type=int, default=0,
+                        help='Requests handled at once; the rest get 503 with Retry-After (default: off)')
+    parser.add_argument('--uploads-dir', default=app.config['UPLOAD_DIR'],
+                        help=f"Where uploads are stored and served from (default: {app.config['UPLOAD_DIR']})")
+    args = parser.parse_args()
+    app.config['COMPRESS'] = args.compress
+    app.config['PERF'] = args.perf
+    app.config['THROTTLE_RATE'] = args.throttle
+    app.config['MAX_CONCURRENT'] = args.max_concurrent
+    app.config['UPLOAD_DIR'] = os.path.abspath(args.uploads_dir)
+    os.makedirs(app.config['UPLOAD_DIR'], exist_ok=True)
+    throttle['tokens'] = args.throttle
+    
+    print(f"Starting mock WordPress server on {'https' if args.cert else 'http'}://localhost:{args.port}")
     print("Username: test")
     print("Password: test123QWE@AD")
-    app.run(host='0.0.0.0', port=8000, debug=True)
+    ssl_context = (args.cert, args.key) if args.cert else None
+    if args.perf:
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        app.run(host='0.0.0.0', port=args.port, threaded=True, request_handler=KeepAliveHandler,
+                ssl_context=ssl_context)
+    else:
+        app.run(host='0.0.0.0', port=args.port, debug=True, ssl_context=ssl_context)
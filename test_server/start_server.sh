@@ -4,4 +4,4 @@
 source myenv/bin/activate
 
 echo "Starting local WordPress test server..."
-python3 local_wordpress_server.py
+python3 local_wordpress_server.py "$@"